@@ -0,0 +1,89 @@
+# libraries
+import numpy as np
+from . import defaults
+from .lazy import lazy_import
+
+# scipy is only imported when a file has control data to smooth
+signal = lazy_import("scipy.signal")
+
+# controllers turned into control curves : name -> (CC number, MIDI default value)
+CONTROLLERS = {
+    'modulation': (1, 0),
+    'volume': (7, 100),
+    'expression': (11, 127),
+    'brightness': (74, 64),
+}
+CC_NAMES = {cc: name for name, (cc, _) in CONTROLLERS.items()}
+
+# keeps the control events of a MIDI message, as (time, controller name, raw value)
+## pitch bend values are kept signed, from -8192 to 8191
+def control_event(msg, time):
+    if msg.type == "control_change" and msg.control in CC_NAMES:
+        return (time, CC_NAMES[msg.control], msg.value)
+    if msg.type == "pitchwheel":
+        return (time, 'pitch_bend', msg.pitch)
+    return None
+
+# sample-accurate step curve from sorted (sample index, value) pairs
+def step_curve(indices, values, n_samples, default):
+    indices = np.clip(indices, 0, n_samples)
+    ## each value holds until the next event ; later events at the same sample win
+    lengths = np.diff(np.concatenate([[0], indices, [n_samples]]))
+    return np.repeat(np.concatenate([[default], values]).astype(np.float32), lengths)
+
+# one-pole smoothing, so steps in the control data don't click
+def smooth(curve, smoothing):
+    if smoothing <= 0 or len(curve) == 0:
+        return curve
+    alpha = 1.0 - np.exp(-1.0 / (smoothing * defaults.SAMPLE_RATE))
+    zi = [(1.0 - alpha) * curve[0]]
+    out, _ = signal.lfilter([alpha], [1.0, alpha - 1.0], curve, zi = zi)
+    return out.astype(np.float32)
+
+# builds the control curves of a render, once, as arrays of n_samples values
+## only controllers present in the file get a curve :
+## pitch_bend in semitones, modulation / volume / expression from 0 to 1, brightness from -1 to 1 (64 = 0)
+## offset : first sample of the curves in the song, events before it only set the starting values
+def build_control_curves(events, n_samples, automation = None, offset = 0):
+    if automation is None:
+        automation = defaults.DEFAULT_AUTOMATION
+    curves = {}
+    if not automation['enabled'] or not events:
+        return curves
+    times = np.array([e[0] for e in events], dtype = np.float64)
+    names = np.array([e[1] for e in events])
+    values = np.array([e[2] for e in events], dtype = np.float32)
+    indices = (times * defaults.SAMPLE_RATE).astype(np.int64) - offset
+    for name in np.unique(names):
+        mask = names == name
+        idx, val = indices[mask], values[mask]
+        if name == 'pitch_bend':
+            curve = step_curve(idx, val / 8192.0 * automation['bend_range'], n_samples, 0.0)
+        elif name == 'brightness':
+            curve = step_curve(idx, (val - 64) / 64.0, n_samples, 0.0)
+        else:
+            curve = step_curve(idx, val / 127.0, n_samples, CONTROLLERS[name][1] / 127.0)
+        curves[str(name)] = smooth(curve, automation['smoothing'])
+    return curves
+
+# global gain from the volume and expression controllers, or None when the file has neither
+def gain_curve(curves):
+    gain = None
+    for name in ('volume', 'expression'):
+        if name in curves:
+            gain = curves[name] if gain is None else gain * curves[name]
+    return gain
+
+# lowpass cutoff curve, moved by the brightness controller around the base cutoff
+def cutoff_curve(curves, cutoff, automation = None):
+    if automation is None:
+        automation = defaults.DEFAULT_AUTOMATION
+    if 'brightness' not in curves:
+        return None
+    return cutoff * 2.0 ** (curves['brightness'] * automation['brightness_range'])
+
+# effect mix curve : the modulation wheel pushes the mix from its setting towards fully wet
+def mix_curve(curves, mix):
+    if 'modulation' not in curves:
+        return None
+    return mix + (1.0 - mix) * curves['modulation']
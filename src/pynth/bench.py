@@ -0,0 +1,335 @@
+# libraries
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import mido
+import numpy as np
+from . import defaults, kernels, midi
+
+# generated MIDI corpora : name -> (duration in seconds, note length in beats, notes per step, step in beats)
+CORPORA = {
+    'sparse': (60.0, 2.0, 1, 4.0),
+    'dense': (30.0, 0.25, 1, 0.25),
+    'long': (300.0, 1.0, 2, 1.0),
+    'polyphony': (20.0, 1.0, 32, 1.0),
+}
+# parameters used for the benchmarked stages
+BENCH_OSC = [dict(o, enabled = True) for o in defaults.DEFAULT_OSCILLATORS]
+BENCH_AM_LFO = dict(defaults.DEFAULT_AM_LFO, enabled = True)
+BENCH_FM_LFO = dict(defaults.DEFAULT_FM_LFO, enabled = True)
+BENCH_FILTERS = {
+    'lowpass': dict(defaults.DEFAULT_FILTERS['lowpass'], enabled = True),
+    'highpass': dict(defaults.DEFAULT_FILTERS['highpass'], enabled = True),
+}
+
+# modules timed by --imports (the budgets and forbidden imports are checked by tests/test_imports.py)
+IMPORT_MODULES = ('pynth.gui', 'pynth.midi')
+
+# writes a deterministic MIDI file for a corpus
+def generate_corpus(name, path, scale = 1.0, seed = 0):
+    duration, note_beats, chord, step_beats = CORPORA[name]
+    duration *= scale
+    rng = random.Random(seed)
+    tpb = 480
+    tempo = defaults.DEFAULT_TEMPO
+    beat_sec = tempo / 1_000_000
+    ## absolute-tick events, sorted and converted to delta times afterwards
+    events = []
+    n_steps = max(1, int(duration / (step_beats * beat_sec)))
+    for step in range(n_steps):
+        on_tick = int(step * step_beats * tpb)
+        off_tick = on_tick + int(note_beats * tpb)
+        notes = rng.sample(range(36, 96), min(chord, 60))
+        for note in notes:
+            velocity = rng.randint(40, 127)
+            events.append((on_tick, 1, mido.Message('note_on', note = note, velocity = velocity)))
+            events.append((off_tick, 0, mido.Message('note_off', note = note, velocity = 0)))
+    events.sort(key = lambda e: (e[0], e[1]))
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage('set_tempo', tempo = tempo, time = 0))
+    last = 0
+    for tick, _, msg in events:
+        track.append(msg.copy(time = tick - last))
+        last = tick
+    mid = mido.MidiFile(ticks_per_beat = tpb)
+    mid.tracks.append(track)
+    mid.save(path)
+    return path
+
+# times a single call, returning its result, wall time and CPU time
+def measure(fn, *args, **kwargs):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = fn(*args, **kwargs)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    return result, wall, cpu
+
+# peak allocation of a single call, measured in a separate run since tracemalloc slows python loops down
+def measure_peak(fn, *args, **kwargs):
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+# encodes FLAC into memory so the benchmark never touches the output folder
+def encode_flac(audio):
+    import soundfile as sf
+    buf = io.BytesIO()
+    sf.write(buf, audio, defaults.SAMPLE_RATE, format = "FLAC")
+    return buf.getvalue()
+
+# runs every stage of the pipeline on one MIDI file
+## each stage first runs once untimed, so lazy imports, cached designs (reverb impulse responses, filters)
+## and compiled kernels are loaded before it is measured, whatever the number of repeats
+def bench_file(path, repeat = 1, memory = True):
+    stages = {}
+    def run(name, fn, *args, **kwargs):
+        ## copy array inputs so in-place stages see the same data on every run
+        def fresh():
+            return [a.copy() if isinstance(a, np.ndarray) else a for a in args]
+        fn(*fresh(), **kwargs)
+        best = None
+        for _ in range(repeat):
+            result, wall, cpu = measure(fn, *fresh(), **kwargs)
+            if best is None or wall < best['wall']:
+                best = {'wall': wall, 'cpu': cpu}
+        best['peak_bytes'] = measure_peak(fn, *fresh(), **kwargs) if memory else 0
+        stages[name] = best
+        return result
+    notes, tempo = run('parse', midi.parse_midi, path)
+    dry = run('synth', midi.render_notes, notes, tempo, osc = BENCH_OSC)
+    run('synth_fm', midi.render_notes, notes, tempo, osc = BENCH_OSC, fm_lfo = BENCH_FM_LFO)
+    audio = midi.normalize(dry)
+    run('am', midi.apply_am_lfo, audio, tempo, BENCH_AM_LFO)
+    for name in ('chorus', 'delay', 'reverb'):
+        run(name, midi.apply_effects, audio, {name: defaults.DEFAULT_EFFECTS[name]})
+    run('lowpass', midi.apply_filters, audio, {'lowpass': BENCH_FILTERS['lowpass']})
+    run('highpass', midi.apply_filters, audio, {'highpass': BENCH_FILTERS['highpass']})
+    run('flac', encode_flac, audio)
+    ## realtime factor : seconds of audio processed per second of wall time
+    audio_sec = len(audio) / defaults.SAMPLE_RATE
+    for s in stages.values():
+        s['realtime_factor'] = audio_sec / s['wall'] if s['wall'] > 0 else float('inf')
+    total_wall = sum(s['wall'] for s in stages.values())
+    return {
+        'notes': len(notes),
+        'audio_seconds': audio_sec,
+        'stages': stages,
+        'total_wall': total_wall,
+        'realtime_factor': audio_sec / total_wall if total_wall > 0 else float('inf'),
+        'peak_bytes': max(s['peak_bytes'] for s in stages.values()),
+    }
+
+# imports a module in a fresh interpreter, returning (cumulative seconds, imported module names)
+def import_time(module):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output = True, text = True,
+                         cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if out.returncode != 0:
+        raise RuntimeError(f"Cannot import {module} : {out.stderr.strip().splitlines()[-1]}")
+    seconds = None
+    names = set()
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        names.add(name)
+        if name == module:
+            seconds = int(cumulative) / 1_000_000
+    return seconds, names
+
+# times the start-up imports, keeping the best of N runs
+def time_imports(repeat = 3):
+    for module in IMPORT_MODULES:
+        runs = [import_time(module) for _ in range(repeat)]
+        seconds = min(r[0] for r in runs)
+        print(f"  {module:<12} {seconds * 1000:7.1f} ms  ({len(runs[0][1])} modules loaded)")
+
+# times renders through a local render server against the same renders in this process
+## a Unix socket server with warm workers : the difference is the cost of the round trip (HTTP, FLAC, queue)
+def time_server(scale = 0.1, repeat = 3):
+    from . import server
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_corpus('dense', os.path.join(tmp, "dense.mid"), scale = scale)
+        with open(path, "rb") as f:
+            data = f.read()
+        sock = os.path.join(tmp, "pynth.sock")
+        params = {'fx': {'chorus': defaults.DEFAULT_EFFECTS['chorus'], 'delay': defaults.DEFAULT_EFFECTS['delay']}, 'osc': BENCH_OSC}
+        srv, stop = server.start_in_thread(socket_path = sock, workers = 1)
+        try:
+            server.render_remote(data, params, socket_path = sock)
+            remote = min(measure(server.render_remote, data, params, socket_path = sock)[1] for _ in range(repeat))
+        finally:
+            stop()
+        midi.midi_to_audio(path, **params)
+        local = min(measure(lambda: encode_flac(midi.midi_to_audio(path, **params)[0]))[1] for _ in range(repeat))
+    print(f"  remote {remote * 1000:9.1f} ms  local {local * 1000:9.1f} ms  round trip {(remote - local) * 1000:8.1f} ms")
+
+# inputs of each kernel, as (kernel, function building fresh arguments, index of the argument holding the result)
+## a result index of None means the returned value (its first element for a tuple) ; the *_block cases run
+## the kernel on a block in the middle of the signal ; also used by tests/test_kernels.py
+def kernel_cases(seconds = 10.0, seed = 0):
+    n = int(seconds * defaults.SAMPLE_RATE)
+    rng = np.random.default_rng(seed)
+    audio = rng.uniform(-1.0, 1.0, n)
+    delay = int(defaults.DEFAULT_EFFECTS['delay']['delay_time'] * defaults.SAMPLE_RATE)
+    t = np.arange(n) / defaults.SAMPLE_RATE
+    max_delay = int(defaults.DEFAULT_EFFECTS['chorus']['depth'] * defaults.SAMPLE_RATE)
+    chorus_delay = (np.sin(2 * np.pi * 1.5 * t) * max_delay).astype(int) + max_delay
+    xs, ys = midi.envelope.adsr_breakpoints(n, 0.5, 0.4, 0.6, 0.8)
+    sos = midi.flt.lowpass_sos(2000.0, 4)
+    zi = midi.flt.signal.sosfilt_zi(sos) * audio[0]
+    return {
+        'delay_feedback': ('delay_feedback', lambda: (np.concatenate([audio, np.zeros(delay)]), delay, 0.4, 0, n), 0),
+        'chorus_read': ('chorus_read', lambda: (audio, chorus_delay, np.zeros(n), 0, n), 2),
+        'chorus_read_block': ('chorus_read', lambda: (audio, chorus_delay[n // 3:n // 2], np.zeros(n), n // 3, n // 2), 2),
+        'adsr': ('adsr', lambda: (xs, ys, 0, n, np.empty(n)), 4),
+        'adsr_block': ('adsr', lambda: (xs, ys, n // 3, n // 2, np.empty(n // 2 - n // 3)), 4),
+        'sosfilt': ('sosfilt', lambda: (sos, audio, zi.copy()), None),
+    }
+
+# times every kernel backend (their results are checked by tests/test_kernels.py)
+## first : the first call, which includes the JIT compilation or the load from the disk cache
+def time_kernels(repeat = 3, seconds = 10.0):
+    backends = ['numpy'] + (['numba'] if kernels.numba_available() else [])
+    if len(backends) == 1:
+        print("  numba is not installed : only the numpy kernels are timed")
+    for name, (kernel, make, _) in kernel_cases(seconds).items():
+        ## the block cases only check the kernels on part of the signal
+        if name.endswith('_block'):
+            continue
+        for backend in backends:
+            fn = kernels.get_kernel(kernel, backend)
+            runs = [measure(fn, *make())[1] for _ in range(repeat + 1)]
+            print(f"  {name:<15} {backend:<6} first {runs[0] * 1000:9.1f} ms  best {min(runs[1:]) * 1000:8.2f} ms  "
+                  f"x{seconds / min(runs[1:]):9.1f} realtime")
+
+# times the live engine on a scripted event stream, for a few block sizes
+## the time per block must stay well under the block duration for the audio thread to keep up
+def time_live(seconds = 10.0, polyphony = 8, seed = 0):
+    from . import live
+    rng = random.Random(seed)
+    events = []
+    for i in range(int(seconds * 8)):
+        t = i / 8 + rng.random() * 0.01
+        note = rng.randint(48, 84)
+        events.append((t, mido.Message('note_on', note = note, velocity = rng.randint(40, 127))))
+        events.append((t + 0.1 + rng.random() * 0.5, mido.Message('note_off', note = note)))
+        if i % 7 == 0:
+            events.append((t + 0.01, mido.Message('pitchwheel', pitch = rng.randint(-8192, 8191))))
+    events.sort(key = lambda e: e[0])
+    for block_size in (64, 256, 1024):
+        engine = live.LiveEngine(voices = dict(defaults.DEFAULT_VOICES, max_polyphony = polyphony), block_size = block_size)
+        (audio, _), wall, _ = measure(live.replay, events, engine)
+        blocks = len(audio) // block_size
+        print(f"  block {block_size:<5} {wall / blocks * 1e6:8.1f} us per block ({block_size / defaults.SAMPLE_RATE * 1e6:.0f} us of audio)  "
+              f"x{len(audio) / defaults.SAMPLE_RATE / wall:.1f} realtime")
+
+# current commit, so saved results can be matched to the tree they came from
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, cwd = os.path.dirname(__file__))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+# runs the whole suite
+def run_suite(corpora = None, scale = 1.0, repeat = 1, memory = True):
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'kernels': kernels.active_backend(),
+        'scale': scale,
+        'corpora': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in corpora or CORPORA:
+            path = generate_corpus(name, os.path.join(tmp, f"{name}.mid"), scale = scale)
+            results['corpora'][name] = bench_file(path, repeat = repeat, memory = memory)
+    return results
+
+# prints one result table
+def print_results(results):
+    for name, r in results['corpora'].items():
+        print(f"{name} : {r['notes']} notes, {r['audio_seconds']:.1f} s of audio, "
+              f"x{r['realtime_factor']:.2f} realtime, peak {r['peak_bytes'] / 2**20:.1f} MiB")
+        for stage, s in r['stages'].items():
+            print(f"  {stage:<10} {s['wall'] * 1000:9.1f} ms  cpu {s['cpu'] * 1000:9.1f} ms  "
+                  f"x{s['realtime_factor']:9.2f}  {s['peak_bytes'] / 2**20:8.1f} MiB")
+
+# prints the wall time ratio between two saved results (> 1 means slower)
+def compare(old, new, threshold = 1.1):
+    regressions = 0
+    for name, r in new['corpora'].items():
+        if name not in old['corpora']:
+            continue
+        print(f"{name} ({old.get('revision')} -> {new.get('revision')})")
+        for stage, s in r['stages'].items():
+            o = old['corpora'][name]['stages'].get(stage)
+            if o is None or o['wall'] == 0:
+                continue
+            ratio = s['wall'] / o['wall']
+            flag = ""
+            if ratio > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {stage:<10} {o['wall'] * 1000:9.1f} ms -> {s['wall'] * 1000:9.1f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+# command line entry point
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pynth.bench", description = "Benchmarks the pynth render pipeline")
+    parser.add_argument("--corpus", action = "append", choices = list(CORPORA), help = "corpus to run (repeatable, default: all)")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplies the duration of every corpus")
+    parser.add_argument("--repeat", type = int, default = 1, help = "keeps the best of N runs per stage")
+    parser.add_argument("--no-memory", action = "store_true", help = "skips the (slow) peak memory measurement")
+    parser.add_argument("--out", help = "saves the results as JSON")
+    parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "compares two saved JSON results")
+    parser.add_argument("--imports", action = "store_true", help = "times the start-up imports")
+    parser.add_argument("--server", action = "store_true", help = "times renders through a local render server")
+    parser.add_argument("--kernels", action = "store_true", help = "times the DSP kernels of every backend")
+    parser.add_argument("--backend", choices = ("auto",) + kernels.BACKENDS, help = "kernel backend used by the render (default: PYNTH_KERNELS or numpy)")
+    parser.add_argument("--live", action = "store_true", help = "times the live engine on a scripted event stream")
+    parser.add_argument("--threshold", type = float, default = 1.1, help = "slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+    if args.backend:
+        kernels.set_backend(args.backend)
+    if args.kernels:
+        time_kernels(max(1, args.repeat))
+        return 0
+    if args.imports:
+        time_imports(max(1, args.repeat))
+        return 0
+    if args.live:
+        time_live()
+        return 0
+    if args.server:
+        time_server(args.scale, max(1, args.repeat))
+        return 0
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        return 1 if compare(old, new, args.threshold) else 0
+    results = run_suite(args.corpus, args.scale, args.repeat, not args.no_memory)
+    print_results(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent = 2)
+        print(f"Results saved to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
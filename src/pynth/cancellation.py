@@ -0,0 +1,33 @@
+# libraries
+import threading
+
+# raised inside the render when its token has been cancelled
+class RenderCancelled(Exception):
+    pass
+
+# cooperative cancellation : the render checks the token between note blocks and effect blocks
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise RenderCancelled("Render cancelled")
+
+# checks an optional token
+def check(cancel):
+    if cancel is not None:
+        cancel.check()
+
+# maps the progress of one stage (0 to 1) onto the [lo, hi] part of the overall progress
+def sub_progress(progress, lo, hi):
+    if progress is None:
+        return None
+    return lambda fraction: progress(lo + (hi - lo) * min(max(fraction, 0.0), 1.0))
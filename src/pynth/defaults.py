@@ -58,5 +58,20 @@ DEFAULT_FILTERS = {
     'lowpass': {'enabled': False, 'cutoff': 5000.0, 'order': 4},
     'highpass': {'enabled': False, 'cutoff': 200.0, 'order': 4}
 }
+DEFAULT_AUTOMATION = {
+    'enabled' : True,
+    'smoothing' : 0.005, # seconds
+    'bend_range' : 2.0, # semitones
+    'brightness_range' : 2.0 # octaves
+}
+DEFAULT_VOICES = {
+    'max_polyphony' : 64,
+    'steal' : 'oldest' # oldest, quietest or same-note
+}
+WAVEFORMS = ('sine', 'saw', 'square', 'triangle')
+STEAL_POLICIES = ('oldest', 'quietest', 'same-note')
 DEFAULT_TEMPO = 500000 # 120bpm, in microseconds per beat
-SAMPLE_RATE = 44100
\ No newline at end of file
+SAMPLE_RATE = 44100
+EFFECT_BLOCK_SIZE = 4096 # samples processed between two cancellation checks in the effects
+VOICE_BLOCK_SIZE = 8192 # samples per voice buffer, notes are rendered block by block
+STEAL_FADE = 0.005 # fade-out of a stolen note from the time its voice is taken, in seconds
\ No newline at end of file
@@ -1,31 +1,48 @@
+from functools import lru_cache
 import numpy as np
-from scipy.signal import fftconvolve, butter, filtfilt
-from. import defaults
+from. import defaults, kernels
+from .cancellation import check
+from .lazy import lazy_import
+
+# scipy is only imported when the reverb is used
+signal = lazy_import("scipy.signal")
+sp_fft = lazy_import("scipy.fft")
+
+# yields the (start, stop) blocks of a buffer, checking for cancellation and reporting progress between them
+def blocks(length, cancel = None, progress = None, block_size = None):
+    block_size = block_size or defaults.EFFECT_BLOCK_SIZE
+    for start in range(0, length, block_size):
+        check(cancel)
+        stop = min(start + block_size, length)
+        yield start, stop
+        if progress is not None:
+            progress(stop / length)
 
 # chorus
-def apply_chorus(audio, rate=1.5, depth=0.002, mix=0.5):
+## offset : position of the first sample in the song, so the LFO keeps its phase in a region
+## the LFO and the delays are computed block by block, so a long render doesn't hold them all at once
+def apply_chorus(audio, rate=1.5, depth=0.002, mix=0.5, cancel=None, progress=None, offset=0):
     length = len(audio)
-    t = np.arange(length) / defaults.SAMPLE_RATE
-    lfo = np.sin(2 * np.pi * rate * t)
     max_delay = int(depth * defaults.SAMPLE_RATE)
-    delay_samples = (lfo * max_delay).astype(int) + max_delay
     output = np.zeros_like(audio)
-    for i in range(length):
-        delayed_idx = i - delay_samples[i]
-        if 0 <= delayed_idx < length:
-            output[i] = audio[delayed_idx]
+    read = kernels.get_kernel('chorus_read')
+    for start, stop in blocks(length, cancel, progress):
+        t = np.arange(offset + start, offset + stop) / defaults.SAMPLE_RATE
+        lfo = np.sin(2 * np.pi * rate * t)
+        delay_samples = (lfo * max_delay).astype(int) + max_delay
+        read(audio, delay_samples, output, start, stop)
     result = audio * (1 - mix) + output * mix   
     return result
 
 # delay
-def apply_delay(audio, delay_time = 0.3, feedback = 0.5, mix = 0.3):
+def apply_delay(audio, delay_time = 0.3, feedback = 0.5, mix = 0.3, cancel=None, progress=None):
     delay_samples = int(delay_time * defaults.SAMPLE_RATE)
     output = np.copy(audio)
     delayed = np.zeros(len(audio) + delay_samples)
     delayed[:len(audio)] = audio
-    for i in range(len(audio)):
-        if i + delay_samples < len(delayed):
-            delayed[i + delay_samples] += delayed[i] * feedback
+    feed = kernels.get_kernel('delay_feedback')
+    for start, stop in blocks(len(audio), cancel, progress):
+        feed(delayed, delay_samples, feedback, start, stop)
     delayed = delayed[:len(audio)]
     output = audio * (1 - mix) + delayed * mix
     peak = np.max(np.abs(output))
@@ -34,23 +51,40 @@ def apply_delay(audio, delay_time = 0.3, feedback = 0.5, mix = 0.3):
     return output
 
 # reverb
-def apply_reverb(audio, room_size=0.5, damping=0.5, mix=0.3):
+## the convolution is done block by block (overlap-add) so a long render can be cancelled in between
+REVERB_BLOCK_SIZE = 1 << 16
+
+## impulse response spectrum, built once per setting and kept between renders : (n_fft, spectrum)
+## the response has a unit L2 norm, so the wet level follows the input level and doesn't depend on the
+## rendered window (a region gets the same wet signal as the full render) ; the noise is seeded by the setting,
+## so every process (server and sweep workers) builds the same response
+@lru_cache(maxsize=16)
+def reverb_spectrum(room_size, damping):
     reverb_time = 0.5 + room_size * 2.0
     ir_length = int(reverb_time * defaults.SAMPLE_RATE)
     t = np.arange(ir_length) / defaults.SAMPLE_RATE
     decay = np.exp(-3 * t / reverb_time)
-    noise = np.random.randn(ir_length)
+    rng = np.random.default_rng(np.array([room_size, damping], dtype = np.float64).view(np.uint64))
+    noise = rng.standard_normal(ir_length)
     impulse = noise * decay
     if damping > 0:
         cutoff = 8000 * (1 - damping * 0.7)
-        b, a = butter(2, cutoff / (defaults.SAMPLE_RATE / 2), 'low')
-        impulse = filtfilt(b, a, impulse)
-    impulse /= np.max(np.abs(impulse))
-    wet = fftconvolve(audio, impulse, mode='full')
-    wet = wet[:len(audio)]
-    wet_peak = np.max(np.abs(wet))
-    if wet_peak > 0:
-        wet /= wet_peak
+        b, a = signal.butter(2, cutoff / (defaults.SAMPLE_RATE / 2), 'low')
+        impulse = signal.filtfilt(b, a, impulse)
+    impulse /= np.linalg.norm(impulse)
+    n_fft = sp_fft.next_fast_len(REVERB_BLOCK_SIZE + ir_length - 1, real = True)
+    impulse_fft = sp_fft.rfft(impulse, n_fft)
+    impulse_fft.flags.writeable = False
+    return n_fft, impulse_fft
+
+def apply_reverb(audio, room_size=0.5, damping=0.5, mix=0.3, cancel=None, progress=None):
+    n_fft, impulse_fft = reverb_spectrum(float(room_size), float(damping))
+    length = len(audio)
+    wet = np.zeros(length)
+    for start, stop in blocks(length, cancel, progress, REVERB_BLOCK_SIZE):
+        block = sp_fft.irfft(sp_fft.rfft(audio[start:stop].astype(np.float64), n_fft) * impulse_fft, n_fft)
+        end = min(length, start + n_fft)
+        wet[start:end] += block[:end - start]
     result = audio * (1 - mix) + wet * mix
     peak = np.max(np.abs(result))
     if peak > 1.0:
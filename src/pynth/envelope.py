@@ -1,15 +1,28 @@
 import numpy as np
-from. import defaults
+from. import defaults, kernels
 
-# creates the envelope
-def generate_adsr(num_samples, attack, decay, sustain, release):
+# computes the envelope breakpoints : (sample indices, levels), linear in between
+## evaluated all at once by generate_adsr, or block by block by adsr_block
+def adsr_breakpoints(num_samples, attack, decay, sustain, release):
+    xs = []
+    ys = []
+    ## adds a linear segment, like np.linspace(start_level, end_level, length) written at idx
+    def segment(idx, length, start_level, end_level):
+        xs.append(idx)
+        ys.append(start_level)
+        if length > 1:
+            xs.append(idx + length - 1)
+            ys.append(end_level)
+        return idx + length
     if num_samples == 0:
-        return np.array([]) 
+        return np.array(xs), np.array(ys)
     ## short notes : simple fade-in/out
     if num_samples < 10:
-        envelope = np.linspace(0, 1, num_samples // 2 + 1)
-        envelope = np.concatenate([envelope, np.linspace(1, 0, num_samples - len(envelope))])
-        return envelope[:num_samples]
+        up = num_samples // 2 + 1
+        idx = segment(0, up, 0.0, 1.0)
+        if num_samples > up:
+            segment(idx, num_samples - up, 1.0, 0.0)
+        return np.array(xs, dtype = float), np.array(ys, dtype = float)
     
     note_duration = num_samples / defaults.SAMPLE_RATE
     attack_samples = int(attack * defaults.SAMPLE_RATE)
@@ -34,23 +47,41 @@ def generate_adsr(num_samples, attack, decay, sustain, release):
         else:
             sustain_samples = num_samples - attack_samples - decay_samples - release_samples
     
-    # builds the envelope
-    envelope = np.zeros(num_samples)
-    idx = 0   
+    # builds the breakpoints
+    idx = 0
+    level = 0.0
     if attack_samples > 0:
-        envelope[idx:idx + attack_samples] = np.linspace(0, 1, attack_samples)
-        idx += attack_samples
+        idx = segment(idx, attack_samples, 0.0, 1.0)
+        level = 1.0 if attack_samples > 1 else 0.0
     if decay_samples > 0:
-        envelope[idx:idx + decay_samples] = np.linspace(1, sustain, decay_samples)
-        idx += decay_samples
+        idx = segment(idx, decay_samples, 1.0, sustain)
+        level = sustain if decay_samples > 1 else 1.0
     if sustain_samples > 0:
-        envelope[idx:idx + sustain_samples] = sustain
-        idx += sustain_samples
+        idx = segment(idx, sustain_samples, sustain, sustain)
+        level = sustain
     if release_samples > 0:
-        if idx > 0:
-            start_level = envelope[idx - 1]
-        else:
-            start_level = 0
-        envelope[idx:idx + release_samples] = np.linspace(start_level, 0, release_samples)
+        idx = segment(idx, release_samples, level, 0.0)
+        level = 0.0 if release_samples > 1 else level
+    ## samples left after the release stay silent
+    if idx < num_samples:
+        segment(idx, 1, 0.0, 0.0)
     
-    return envelope
\ No newline at end of file
+    return np.array(xs, dtype = float), np.array(ys, dtype = float)
+
+# evaluates samples [start, stop) of the envelope from its breakpoints
+## fill : the 'adsr' kernel, looked up once by the caller when it renders many blocks
+def adsr_block(breakpoints, start, stop, fill = None):
+    xs, ys = breakpoints
+    out = np.empty(stop - start)
+    if len(xs) == 0:
+        out.fill(0.0)
+        return out
+    ## linear ramps between consecutive breakpoints, see kernels.adsr_fill
+    (fill or kernels.get_kernel('adsr'))(xs, ys, start, stop, out)
+    return out
+
+# creates the envelope
+def generate_adsr(num_samples, attack, decay, sustain, release):
+    if num_samples == 0:
+        return np.array([]) 
+    return adsr_block(adsr_breakpoints(num_samples, attack, decay, sustain, release), 0, num_samples)
@@ -1,15 +1,87 @@
+from functools import lru_cache
 import numpy as np
-from scipy.signal import butter, filtfilt
-from . import defaults
+from . import defaults, kernels
+from .cancellation import check
+from .lazy import lazy_import
 
-def apply_lowpass(audio, cutoff = 5000.0, order = 4) :
+# scipy is only imported when a filter is used
+signal = lazy_import("scipy.signal")
+
+# filter designs are kept between renders
+@lru_cache(maxsize = 64)
+def butter_ba(cutoff, order, btype):
+    nyq = defaults.SAMPLE_RATE / 2
+    return signal.butter(order, cutoff / nyq, btype = btype)
+
+# zero-phase filtering, like scipy's filtfilt (odd extension, steady-state initial conditions),
+## run block by block so a render can be cancelled in between ; lfilter carries its state from block to block,
+## so the result is the same as a single filtfilt call
+FILTER_BLOCK_SIZE = 1 << 16
+
+def _lfilter_blocks(b, a, x, zi, cancel):
+    out = np.empty(len(x), dtype = np.result_type(b, a, x))
+    for start in range(0, len(x), FILTER_BLOCK_SIZE):
+        check(cancel)
+        stop = start + FILTER_BLOCK_SIZE
+        out[start:stop], zi = signal.lfilter(b, a, x[start:stop], zi = zi)
+    return out
+
+def filtfilt(b, a, audio, cancel = None):
+    pad = 3 * max(len(a), len(b))
+    if len(audio) <= pad:
+        return signal.filtfilt(b, a, audio)
+    ext = np.concatenate((2 * audio[0] - audio[pad:0:-1], audio, 2 * audio[-1] - audio[-2:-(pad + 2):-1]))
+    zi = signal.lfilter_zi(b, a)
+    forward = _lfilter_blocks(b, a, ext, zi * ext[0], cancel)
+    backward = _lfilter_blocks(b, a, forward[::-1], zi * forward[-1], cancel)
+    return backward[::-1][pad:-pad]
+
+def apply_lowpass(audio, cutoff = 5000.0, order = 4, cancel = None) :
     nyq = defaults.SAMPLE_RATE / 2
     cutoff = np.clip(cutoff, 20.0, nyq - 1.0)
-    b, a = butter(order, cutoff / nyq, btype = 'low')
-    return filtfilt(b, a, audio).astype(np.float32)
+    b, a = butter_ba(float(cutoff), int(order), 'low')
+    return filtfilt(b, a, audio, cancel).astype(np.float32)
 
-def apply_highpass(audio, cutoff = 200.0, order = 4):
+def apply_highpass(audio, cutoff = 200.0, order = 4, cancel = None):
     nyq = defaults.SAMPLE_RATE / 2
     cutoff = np.clip(cutoff, 20.0, nyq - 1.0)
-    b, a = butter(order, cutoff / nyq, btype = 'high')
-    return filtfilt(b, a, audio).astype(np.float32)
\ No newline at end of file
+    b, a = butter_ba(float(cutoff), int(order), 'high')
+    return filtfilt(b, a, audio, cancel).astype(np.float32)
+
+# lowpass with a time-varying cutoff (one value per sample), e.g. from the brightness controller
+## the cutoff is updated every MOD_BLOCK_SIZE samples and rounded to MOD_STEPS_PER_OCTAVE steps,
+## so only a handful of filters are designed ; like filtfilt, it runs forward then backward
+MOD_BLOCK_SIZE = 512
+MOD_STEPS_PER_OCTAVE = 24
+# blocks filtered between two cancellation checks
+MOD_CHECK_BLOCKS = 64
+
+@lru_cache(maxsize = 256)
+def lowpass_sos(cutoff, order):
+    nyq = defaults.SAMPLE_RATE / 2
+    return signal.butter(order, cutoff / nyq, btype = 'low', output = 'sos')
+
+def _sosfilt_modulated(audio, cutoff_curve, order, cancel = None):
+    nyq = defaults.SAMPLE_RATE / 2
+    cutoffs = np.clip(cutoff_curve[::MOD_BLOCK_SIZE], 20.0, nyq - 1.0)
+    steps = np.round(np.log2(cutoffs / 20.0) * MOD_STEPS_PER_OCTAVE) / MOD_STEPS_PER_OCTAVE
+    cutoffs = np.minimum(20.0 * 2.0 ** steps, nyq - 1.0)
+    out = np.empty(len(audio), dtype = np.float64)
+    sosfilt = kernels.get_kernel('sosfilt')
+    zi = None
+    for b, start in enumerate(range(0, len(audio), MOD_BLOCK_SIZE)):
+        if b % MOD_CHECK_BLOCKS == 0:
+            check(cancel)
+        sos = lowpass_sos(float(cutoffs[b]), order)
+        if zi is None:
+            zi = signal.sosfilt_zi(sos) * audio[0]
+        stop = start + MOD_BLOCK_SIZE
+        out[start:stop], zi = sosfilt(sos, audio[start:stop], zi = zi)
+    return out
+
+def apply_lowpass_modulated(audio, cutoff_curve, order = 4, cancel = None):
+    if len(audio) == 0:
+        return audio.astype(np.float32)
+    forward = _sosfilt_modulated(audio, cutoff_curve, order, cancel)
+    backward = _sosfilt_modulated(forward[::-1], cutoff_curve[::-1], order, cancel)
+    return backward[::-1].astype(np.float32)
@@ -1,13 +1,25 @@
 # libraries
 import math
 import customtkinter as ctk
+import tkinter as tk
 from tkinter import filedialog, messagebox
 import threading
 from pathlib import Path
-import sounddevice as sd
 
 # import default values
-from pynth.defaults import DEFAULT_ADSR, DEFAULT_EFFECTS, DEFAULT_AM_LFO, DEFAULT_FM_LFO, DEFAULT_OSCILLATORS, DEFAULT_FILTERS
+from pynth.defaults import DEFAULT_ADSR, DEFAULT_EFFECTS, DEFAULT_AM_LFO, DEFAULT_FM_LFO, DEFAULT_OSCILLATORS, DEFAULT_FILTERS, SAMPLE_RATE
+from pynth.telemetry import Telemetry
+from pynth.cancellation import CancelToken, RenderCancelled
+from pynth.lazy import lazy_import, warm_up
+
+# the audio device and render stack are loaded after the window is shown (see PynthGUI.warm_up)
+sd = lazy_import("sounddevice")
+## the numba kernels are only loaded when the kernel backend uses them (see pynth.kernels)
+def prepare_kernels():
+    from pynth import kernels
+    kernels.prepare()
+
+WARM_UP_MODULES = ["pynth.midi", "scipy.signal", "scipy.fft", "soundfile", "sounddevice", prepare_kernels]
 
 # theme setup
 ctk.set_appearance_mode("system")
@@ -27,6 +39,10 @@ class PynthGUI(ctk.CTk):
         ## I/O paths
         self.midi_path = ctk.StringVar()
         self.output_path = ctk.StringVar()
+        ## region (empty : whole song) and preview loop
+        self.region_start = ctk.StringVar()
+        self.region_end = ctk.StringVar()
+        self.loop_preview = ctk.BooleanVar(value=False)
         ## oscillators
         self.osc_enabled = [ctk.BooleanVar(value=o["enabled"]) for o in DEFAULT_OSCILLATORS]
         self.osc_waveform = [ctk.StringVar(value=o["waveform"]) for o in DEFAULT_OSCILLATORS]
@@ -73,9 +89,22 @@ class PynthGUI(ctk.CTk):
         self.hp_order   = ctk.IntVar(value=DEFAULT_FILTERS['highpass']['order'])
         ## status and preview audio
         self.status = ctk.StringVar(value="Ready")
+        self.telemetry_text = ctk.StringVar(value="")
+        self.progress = ctk.DoubleVar(value=0.0)
+        self.render_token = None
         self.preview_audio = None
+        ## overview of the last preview, and the samples shown
+        self.overview = None
+        self.overview_view = [0, 0]
+        self.overview_image = None
+        self.overview_text = ctk.StringVar(value="Preview a file to see its waveform and spectrum")
         # call to build the UI
         self.build_ui()
+        self.after(100, self.warm_up)
+
+    # imports the heavy modules in the background once the window is up
+    def warm_up(self):
+        warm_up(WARM_UP_MODULES)
 
     # building the UI
     def build_ui(self):
@@ -91,9 +120,11 @@ class PynthGUI(ctk.CTk):
         osc_env_tab = tabs.add("Oscillators & Envelope")
         fx_tab = tabs.add("Effects")
         filter_tab = tabs.add("Filters")
+        overview_tab = tabs.add("Overview")
         self.build_osc_env(osc_env_tab)
         self.build_effects(fx_tab)
         self.build_filters(filter_tab)
+        self.build_overview(overview_tab)
         # bottom frame : file selection and preview/export
         bottom = ctk.CTkFrame(self)
         bottom.grid(row=1, column=0, sticky="ew", padx=10, pady=(0, 10))
@@ -396,6 +427,103 @@ class PynthGUI(ctk.CTk):
         update_state()
         return {'slider': freq_slider, 'pos_var': pos_var}
 
+    # build the overview tab : waveform and spectrum of the last preview
+    ## drawn from a pynth.overview.Overview computed once per render, so zooming never reads the samples
+    ## wheel : zoom around the mouse, drag : pan, double-click : whole render
+    def build_overview(self, parent):
+        ctk.CTkLabel(parent, textvariable=self.overview_text).pack(pady=(5, 0))
+        self.wave_canvas = tk.Canvas(parent, height=160, bg="#1a1a1a", highlightthickness=0)
+        self.wave_canvas.pack(fill="both", expand=True, padx=10, pady=(5, 2))
+        self.spec_canvas = tk.Canvas(parent, height=140, bg="#000000", highlightthickness=0)
+        self.spec_canvas.pack(fill="both", expand=True, padx=10, pady=(2, 10))
+        for canvas in (self.wave_canvas, self.spec_canvas):
+            canvas.bind("<Configure>", lambda _: self.draw_overview())
+            canvas.bind("<MouseWheel>", lambda e: self.zoom_overview(e, 1 if e.delta > 0 else -1))
+            canvas.bind("<Button-4>", lambda e: self.zoom_overview(e, 1))
+            canvas.bind("<Button-5>", lambda e: self.zoom_overview(e, -1))
+            canvas.bind("<ButtonPress-1>", self.start_pan)
+            canvas.bind("<B1-Motion>", self.pan_overview)
+            canvas.bind("<Double-Button-1>", lambda _: self.reset_overview())
+
+    def show_overview(self, overview):
+        self.overview = overview
+        self.reset_overview()
+
+    def reset_overview(self):
+        if self.overview is not None:
+            self.overview_view = [0, self.overview.length]
+            self.draw_overview()
+
+    ## zooms in or out around the mouse, down to one peak bucket per pixel
+    def zoom_overview(self, event, direction):
+        if self.overview is None:
+            return
+        start, stop = self.overview_view
+        width = max(1, event.widget.winfo_width())
+        anchor = start + (stop - start) * event.x / width
+        span = (stop - start) * (0.8 if direction > 0 else 1.25)
+        span = min(self.overview.length, max(span, width * self.overview.peaks.base))
+        start = min(max(0, anchor - span * event.x / width), self.overview.length - span)
+        self.overview_view = [start, start + span]
+        self.draw_overview()
+
+    def start_pan(self, event):
+        self.pan_from = (event.x, list(self.overview_view))
+
+    def pan_overview(self, event):
+        if self.overview is None:
+            return
+        x0, (start, stop) = self.pan_from
+        shift = (x0 - event.x) * (stop - start) / max(1, event.widget.winfo_width())
+        shift = min(max(shift, -start), self.overview.length - stop)
+        self.overview_view = [start + shift, stop + shift]
+        self.draw_overview()
+
+    def draw_overview(self):
+        if self.overview is None:
+            return
+        self.draw_waveform()
+        self.draw_spectrum()
+        start, stop = self.overview_view
+        peaks = self.overview.peaks
+        clipped = f", {peaks.clipped} samples over full scale" if peaks.clipped else ""
+        self.overview_text.set(f"{start / SAMPLE_RATE:.2f} s - {stop / SAMPLE_RATE:.2f} s of {self.overview.duration:.2f} s, peak {peaks.peak:.3f}{clipped}")
+
+    ## one zigzag line from the max to the min of each pixel column, columns over full scale in red
+    def draw_waveform(self):
+        canvas = self.wave_canvas
+        canvas.delete("all")
+        w, h = canvas.winfo_width(), canvas.winfo_height()
+        if w < 2 or h < 2:
+            return
+        mins, maxs = self.overview.peaks.view(*self.overview_view, w)
+        mid = h / 2
+        scale = (mid - 2) / max(1.0, self.overview.peaks.peak)
+        canvas.create_line(0, mid, w, mid, fill="#444444")
+        for level in (-1.0, 1.0):
+            canvas.create_line(0, mid - level * scale, w, mid - level * scale, fill="#333333", dash=(2, 4))
+        points = []
+        for x, (lo, hi) in enumerate(zip(mins.tolist(), maxs.tolist())):
+            points += (x, mid - hi * scale, x, mid - lo * scale + 1)
+            if hi > 1.0 or lo < -1.0:
+                canvas.create_line(x, 0, x, h, fill="#802020")
+        if len(points) >= 4:
+            canvas.create_line(*points, fill="#2fa572")
+
+    def draw_spectrum(self):
+        from pynth.overview import spectrum_image
+        canvas = self.spec_canvas
+        canvas.delete("all")
+        w, h = canvas.winfo_width(), canvas.winfo_height()
+        if w < 2 or h < 2:
+            return
+        data = spectrum_image(self.overview.spectrum.view(*self.overview_view, w), h)
+        if not data:
+            return
+        self.overview_image = tk.PhotoImage(width=w, height=h)
+        self.overview_image.put(data)
+        canvas.create_image(0, 0, anchor="nw", image=self.overview_image)
+
     # build the file selection frame
     def build_files(self, parent):
         frame = ctk.CTkFrame(parent)
@@ -406,6 +534,13 @@ class PynthGUI(ctk.CTk):
         ctk.CTkLabel(frame, text="Output").grid(row=1, column=0, sticky="w")
         ctk.CTkEntry(frame, textvariable=self.output_path, width=300).grid(row=1, column=1, padx=5)
         ctk.CTkButton(frame, text="Browse", command=self.browse_output).grid(row=1, column=2)
+        ctk.CTkLabel(frame, text="Region").grid(row=2, column=0, sticky="w")
+        region = ctk.CTkFrame(frame, fg_color="transparent")
+        region.grid(row=2, column=1, columnspan=2, sticky="w", padx=5, pady=(5, 0))
+        ctk.CTkEntry(region, textvariable=self.region_start, width=80).pack(side="left")
+        ctk.CTkLabel(region, text="to").pack(side="left", padx=5)
+        ctk.CTkEntry(region, textvariable=self.region_end, width=80).pack(side="left")
+        ctk.CTkCheckBox(region, text="Loop preview", variable=self.loop_preview).pack(side="left", padx=10)
 
     # build the actions frame
     def build_actions(self, parent):
@@ -416,7 +551,11 @@ class PynthGUI(ctk.CTk):
         ctk.CTkButton(btn_frame, text="Preview", command=self.preview_audio_action).pack(side="left", padx=5)
         ctk.CTkButton(btn_frame, text="Stop", command=self.stop_audio).pack(side="left", padx=5)
         ctk.CTkButton(btn_frame, text="Render & Export", command=self.render_audio).pack(side="left", padx=5)
-        ctk.CTkLabel(frame, textvariable=self.status).pack(pady=(4, 6))
+        ctk.CTkButton(btn_frame, text="Sweep", command=self.sweep_audio).pack(side="left", padx=5)
+        ctk.CTkButton(btn_frame, text="Cancel", command=self.cancel_render).pack(side="left", padx=5)
+        ctk.CTkProgressBar(frame, variable=self.progress).pack(fill="x", padx=10, pady=(6, 0))
+        ctk.CTkLabel(frame, textvariable=self.status).pack(pady=(4, 0))
+        ctk.CTkLabel(frame, textvariable=self.telemetry_text, font=ctk.CTkFont(size=11)).pack(pady=(0, 6))
 
     # build sliders
     ## labeled slider
@@ -503,25 +642,112 @@ class PynthGUI(ctk.CTk):
         }
         return adsr, effects, oscillators, am_lfo, fm_lfo, filters
 
+    # region getter : None for the whole song, times as seconds or m:ss
+    @staticmethod
+    def parse_time(text):
+        text = text.strip()
+        if not text:
+            return None
+        if ":" in text:
+            minutes, seconds = text.split(":", 1)
+            return int(minutes) * 60 + float(seconds)
+        return float(text)
+
+    def get_region(self):
+        start = self.parse_time(self.region_start.get())
+        end = self.parse_time(self.region_end.get())
+        if start is None and end is None:
+            return None
+        start = start or 0.0
+        end = end if end is not None else math.inf
+        if end <= start:
+            raise ValueError("The region must end after it starts")
+        return (start, end)
+
+    # starts a new render, cancelling the one still running (if any)
+    def new_render(self):
+        if self.render_token is not None:
+            self.render_token.cancel()
+        token = CancelToken()
+        self.render_token = token
+        self.progress.set(0.0)
+        return token
+
+    ## only the latest render may update the status, progress and telemetry
+    def is_current(self, token):
+        return token is self.render_token
+
+    ## progress callback, throttled to 1 % steps
+    def make_progress(self, token):
+        last = [0.0]
+        def progress(fraction):
+            if self.is_current(token) and (fraction - last[0] >= 0.01 or fraction >= 1.0):
+                last[0] = fraction
+                self.progress.set(fraction)
+        return progress
+
+    # render telemetry, shown live under the status
+    ## memory tracking is left off : tracemalloc slows the per-sample effect loops down a lot
+    def make_telemetry(self, token):
+        tel = Telemetry(track_memory=False)
+        def on_stage(stats):
+            if not self.is_current(token):
+                return
+            text = tel.report.summary()
+            if not stats.finished:
+                text = f"{text} | {stats.name}..." if text else f"{stats.name}..."
+            self.telemetry_text.set(text)
+        tel.observer = on_stage
+        return tel
+
+    # cancel the running render and the playback
+    def cancel_render(self):
+        if self.render_token is not None:
+            self.render_token.cancel()
+        sd.stop()
+        self.status.set("Cancelled")
+
     # preview audio
     def preview_audio_action(self):
         if not self.midi_path.get():
             messagebox.showerror("Error", "Select MIDI file")
             return
+        try:
+            region = self.get_region()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid region : {e}")
+            return
+        loop = self.loop_preview.get()
+        ## a new preview replaces the one rendering or playing
+        token = self.new_render()
+        sd.stop()
+        adsr, fx, osc, am_lfo, fm_lfo, filters = self.get_parameters()
         def worker():
             try:
                 from pynth.midi import midi_to_audio
                 self.status.set("Generating preview...")
-                adsr, fx, osc, am_lfo, fm_lfo, filters = self.get_parameters()
-                audio, _ = midi_to_audio(self.midi_path.get(), adsr=adsr, fx=fx if fx else None, osc=osc, am_lfo=am_lfo, fm_lfo=fm_lfo, filters=filters)
+                tel = self.make_telemetry(token)
+                audio, _ = midi_to_audio(self.midi_path.get(), adsr=adsr, fx=fx if fx else None, osc=osc, am_lfo=am_lfo, fm_lfo=fm_lfo, filters=filters, telemetry=tel, progress=self.make_progress(token), cancel=token, region=region)
+                token.check()
+                self.telemetry_text.set(tel.report.summary())
                 self.preview_audio = audio
-                self.status.set("Playing...")
-                sd.play(audio, 44100)
+                self.status.set("Looping..." if loop else "Playing...")
+                sd.play(audio, 44100, loop=loop)
+                ## the overview is computed while the preview plays, then drawn on the main thread
+                from pynth.overview import from_audio
+                overview = from_audio(audio)
+                if self.is_current(token):
+                    self.after(0, self.show_overview, overview)
                 sd.wait()
-                self.status.set("Done")
+                if self.is_current(token) and not token.cancelled:
+                    self.status.set("Done")
+            except RenderCancelled:
+                if self.is_current(token):
+                    self.status.set("Cancelled")
             except Exception as e:
                 messagebox.showerror("Error", str(e))
-                self.status.set("Error")
+                if self.is_current(token):
+                    self.status.set("Error")
         threading.Thread(target=worker, daemon=True).start()
 
     # stop the preview
@@ -534,16 +760,69 @@ class PynthGUI(ctk.CTk):
         if not self.midi_path.get() or not self.output_path.get():
             messagebox.showerror("Error", "Missing paths")
             return
+        try:
+            region = self.get_region()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid region : {e}")
+            return
+        token = self.new_render()
+        adsr, fx, osc, am_lfo, fm_lfo, filters = self.get_parameters()
         def worker():
             try:
                 from pynth.midi import midi_to_flac
                 self.status.set("Rendering...")
-                adsr, fx, osc, am_lfo, fm_lfo, filters = self.get_parameters()
-                midi_to_flac(self.midi_path.get(), self.output_path.get(), adsr=adsr, fx=fx if fx else None, osc=osc, am_lfo=am_lfo, fm_lfo=fm_lfo, filters=filters)
-                self.status.set("Done")
+                tel = self.make_telemetry(token)
+                midi_to_flac(self.midi_path.get(), self.output_path.get(), adsr=adsr, fx=fx if fx else None, osc=osc, am_lfo=am_lfo, fm_lfo=fm_lfo, filters=filters, telemetry=tel, progress=self.make_progress(token), cancel=token, region=region)
+                if self.is_current(token):
+                    self.telemetry_text.set(tel.report.summary())
+                    self.status.set("Done")
+            except RenderCancelled:
+                if self.is_current(token):
+                    self.status.set("Cancelled")
+            except Exception as e:
+                messagebox.showerror("Error", str(e))
+                if self.is_current(token):
+                    self.status.set("Error")
+        threading.Thread(target=worker, daemon=True).start()
+
+    # render a parameter sweep : the current settings under every combination of the grid
+    ## grid as "fx.reverb.mix=0.1,0.3; filters.lowpass.cutoff=2000,4000", see pynth.sweep
+    def sweep_audio(self):
+        if not self.midi_path.get():
+            messagebox.showerror("Error", "Select MIDI file")
+            return
+        try:
+            region = self.get_region()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid region : {e}")
+            return
+        text = ctk.CTkInputDialog(title="Sweep", text="Parameters to sweep (path=value,value; ...)\ne.g. fx.reverb.mix=0.1,0.3; adsr.attack=0.01,0.1").get_input()
+        if not text:
+            return
+        out_dir = filedialog.askdirectory(title="Sweep output folder")
+        if not out_dir:
+            return
+        token = self.new_render()
+        adsr, fx, osc, am_lfo, fm_lfo, filters = self.get_parameters()
+        base = dict(adsr=adsr, fx=fx, osc=osc, am_lfo=am_lfo, fm_lfo=fm_lfo, filters=filters, region=region)
+        def worker():
+            try:
+                from pynth.sweep import parse_grid, grid, run_sweep
+                overrides = grid(parse_grid(text))
+                self.status.set(f"Rendering {len(overrides)} variants...")
+                self.telemetry_text.set("")
+                manifest = run_sweep(self.midi_path.get(), out_dir, base, overrides, cancel=token, progress=self.make_progress(token))
+                computed, naive = manifest['computed'], manifest['naive']
+                if self.is_current(token):
+                    self.telemetry_text.set(f"{manifest['total_seconds']:.2f} s, {computed['tracks']}/{naive['tracks']} oscillator tracks rendered")
+                    self.status.set(f"Done : {len(overrides)} files in {out_dir}")
+            except RenderCancelled:
+                if self.is_current(token):
+                    self.status.set("Cancelled")
             except Exception as e:
                 messagebox.showerror("Error", str(e))
-                self.status.set("Error")
+                if self.is_current(token):
+                    self.status.set("Error")
         threading.Thread(target=worker, daemon=True).start()
 
 
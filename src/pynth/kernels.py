@@ -0,0 +1,166 @@
+# libraries
+import os
+import numpy as np
+from .lazy import lazy_import
+
+# scipy is only imported when a filter is used
+signal = lazy_import("scipy.signal")
+
+# registry of the DSP kernels : the stateful, sample-by-sample loops of the pipeline
+## each kernel has a NumPy reference implementation ('numpy') and, for most, the same kernel written
+## as a plain loop that numba compiles ('numba') ; compiled code is cached on disk by numba
+## (next to this file, or in NUMBA_CACHE_DIR), so the JIT only runs once per machine
+## the backend is picked at runtime, from the PYNTH_KERNELS environment variable or set_backend :
+##  numpy (default) : no JIT, nothing to import or load before the first render
+##  auto : numba for the kernels in AUTO_NUMBA when it is installed, numpy for the others
+##  numba : every kernel that has a numba version
+## importing numba and loading the cached code costs about a second, so numba is opt-in
+BACKENDS = ('numpy', 'numba')
+# kernels where numba clearly beats numpy (see python -m pynth.bench --kernels) : the chorus read
+## is a gather numpy can't do in place ; the others are already vectorized or run in scipy
+AUTO_NUMBA = ('chorus_read',)
+KERNELS = {}
+_state = {'backend': os.environ.get('PYNTH_KERNELS', 'numpy'), 'numba': None, 'numba_error': None, 'warned': False}
+_compiled = {}
+
+def kernel(name, backend = 'numpy'):
+    def register(fn):
+        KERNELS.setdefault(name, {})[backend] = fn
+        return fn
+    return register
+
+# numba module, or None when it can't be imported
+def load_numba():
+    if _state['numba'] is None and _state['numba_error'] is None:
+        try:
+            import numba
+            _state['numba'] = numba
+        except ImportError as e:
+            _state['numba_error'] = e
+    return _state['numba']
+
+def numba_available():
+    return load_numba() is not None
+
+def set_backend(name):
+    if name != 'auto' and name not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend : {name} (auto, {', '.join(BACKENDS)})")
+    _state['backend'] = name
+
+# backend setting in use : numba and auto fall back to numpy, with a message for numba, when it is not installed
+def active_backend():
+    name = _state['backend']
+    if name == 'numpy':
+        return name
+    if numba_available():
+        return name
+    if name == 'numba' and not _state['warned']:
+        _state['warned'] = True
+        print(f"numba is not available ({_state['numba_error']}), using the numpy kernels")
+    return 'numpy'
+
+# backend a kernel runs on with a backend setting (default : the active one)
+def kernel_backend(name, backend = None):
+    backend = backend or active_backend()
+    if backend == 'auto':
+        backend = 'numba' if name in AUTO_NUMBA else 'numpy'
+    if backend != 'numba' or 'numba' not in KERNELS[name] or not numba_available():
+        return 'numpy'
+    return 'numba'
+
+# implementation of a kernel for a backend setting (default : the active one)
+## kernels without a numba version use their numpy one ; look a kernel up once per render, not per block
+def get_kernel(name, backend = None):
+    impl = KERNELS[name]
+    if kernel_backend(name, backend) == 'numpy':
+        return impl['numpy']
+    if name not in _compiled:
+        _compiled[name] = load_numba().njit(cache = True)(impl['numba'])
+    return _compiled[name]
+
+# compiles (or loads from the disk cache) the numba kernels of the active backend, e.g. in a warm-up thread
+def prepare():
+    return [name for name in KERNELS if kernel_backend(name) == 'numba' and get_kernel(name) is not None]
+
+# delay feedback : delayed[i + delay] += delayed[i] * feedback, in order, for i in [start, stop)
+## delayed holds delay samples more than the audio, so i + delay is always in range
+## a sample only feeds one delay later, so a run of up to delay samples has no dependency inside it
+@kernel('delay_feedback')
+def delay_feedback(delayed, delay_samples, feedback, start, stop):
+    if delay_samples == 0:
+        delayed[start:stop] += delayed[start:stop] * feedback
+        return
+    for s in range(start, stop, delay_samples):
+        e = min(s + delay_samples, stop)
+        delayed[s + delay_samples:e + delay_samples] += delayed[s:e] * feedback
+
+@kernel('delay_feedback', 'numba')
+def delay_feedback_loop(delayed, delay_samples, feedback, start, stop):
+    for i in range(start, stop):
+        if i + delay_samples < len(delayed):
+            delayed[i + delay_samples] += delayed[i] * feedback
+
+# chorus modulated read : output[i] = audio[i - delay[i - start]] when that index is in the audio, for i in [start, stop)
+## delay_samples holds the delays of the block only
+@kernel('chorus_read')
+def chorus_read(audio, delay_samples, output, start, stop):
+    idx = np.arange(start, stop) - delay_samples
+    valid = (idx >= 0) & (idx < len(audio))
+    output[start:stop][valid] = audio[idx[valid]]
+
+@kernel('chorus_read', 'numba')
+def chorus_read_loop(audio, delay_samples, output, start, stop):
+    for i in range(start, stop):
+        j = i - delay_samples[i - start]
+        if 0 <= j < len(audio):
+            output[i] = audio[j]
+
+# envelope : samples [start, stop) of the linear ramps between breakpoints (xs, ys), written to out
+## ramps are computed like np.linspace, and the last level holds after the last breakpoint
+@kernel('adsr')
+def adsr_fill(xs, ys, start, stop, out):
+    for i in range(len(xs) - 1):
+        x0, x1 = int(xs[i]), int(xs[i + 1])
+        a = max(start, x0)
+        b = min(stop, x1 + 1)
+        if a < b:
+            slope = (ys[i + 1] - ys[i]) / (x1 - x0)
+            out[a - start:b - start] = np.arange(a - x0, b - x0) * slope + ys[i]
+    last = int(xs[-1])
+    if stop > last:
+        out[max(start, last) - start:] = ys[-1]
+
+@kernel('adsr', 'numba')
+def adsr_fill_loop(xs, ys, start, stop, out):
+    for i in range(len(xs) - 1):
+        x0 = int(xs[i])
+        x1 = int(xs[i + 1])
+        a = max(start, x0)
+        b = min(stop, x1 + 1)
+        if a < b:
+            slope = (ys[i + 1] - ys[i]) / (x1 - x0)
+            for k in range(a, b):
+                out[k - start] = (k - x0) * slope + ys[i]
+    last = int(xs[-1])
+    for k in range(max(start, last), stop):
+        out[k - start] = ys[-1]
+
+# cascade of biquads (second-order sections, transposed direct form II) : returns (output, final state)
+## the reference is scipy's sosfilt ; sos rows are normalized (a0 = 1)
+@kernel('sosfilt')
+def sosfilt(sos, x, zi):
+    return signal.sosfilt(sos, x, zi = zi)
+
+@kernel('sosfilt', 'numba')
+def sosfilt_loop(sos, x, zi):
+    y = np.empty(len(x))
+    z = zi.copy()
+    for i in range(len(x)):
+        v = x[i]
+        for s in range(sos.shape[0]):
+            out = sos[s, 0] * v + z[s, 0]
+            z[s, 0] = sos[s, 1] * v - sos[s, 4] * out + z[s, 1]
+            z[s, 1] = sos[s, 2] * v - sos[s, 5] * out
+            v = out
+        y[i] = v
+    return y, z
@@ -0,0 +1,49 @@
+# libraries
+import importlib
+import threading
+
+_lock = threading.Lock()
+
+# module proxy, imported on first attribute access
+## keeps heavy dependencies (scipy, soundfile, sounddevice) out of the start-up path
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name} ({state})>"
+
+def lazy_import(name):
+    return LazyModule(name)
+
+# imports modules ahead of time, in a background thread by default
+## names : module names, or functions to run in the same thread (e.g. to fill a cache)
+## errors are ignored here : they show up again, with their message, when the module is really used
+def warm_up(names, background = True):
+    def run():
+        for name in names:
+            try:
+                if callable(name):
+                    name()
+                else:
+                    importlib.import_module(name)
+            except Exception:
+                pass
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target = run, name = "pynth-warm-up", daemon = True)
+    thread.start()
+    return thread
@@ -0,0 +1,370 @@
+# libraries
+import argparse
+import heapq
+import math
+import queue
+import sys
+import threading
+import time
+import numpy as np
+from . import defaults, waveform
+from .automation import CC_NAMES
+from .voices import VoiceManager, VoicePool
+from .lazy import lazy_import
+
+# the audio device and MIDI ports are only needed when playing live
+sd = lazy_import("sounddevice")
+mido = lazy_import("mido")
+sf = lazy_import("soundfile")
+
+# live mode : MIDI events in, audio blocks out
+## the engine renders fixed-size blocks ; an event is applied at its exact sample inside a block,
+## a fixed delay (default : one block) after it was received, so the latency stays constant
+DEFAULT_BLOCK_SIZE = 256
+# output gain : live audio can't be normalized after the fact
+DEFAULT_GAIN = 0.25
+
+# block-based synth : oscillators, ADSR, velocity, polyphony, pitch bend and volume / expression
+## times are in samples, counted from the start of the engine
+## osc, adsr, voices : as in midi.render_notes
+class LiveEngine:
+    def __init__(self, osc = None, adsr = None, voices = None, block_size = DEFAULT_BLOCK_SIZE, gain = DEFAULT_GAIN, bend_range = None):
+        adsr = adsr or defaults.DEFAULT_ADSR
+        voices = voices or defaults.DEFAULT_VOICES
+        osc = osc if osc is not None else [{'enabled': True, 'waveform': 'sine', 'volume': 1.0, 'pitch': 0}]
+        self.osc = [o for o in osc if o.get('enabled', True)]
+        self.block_size = block_size
+        self.gain = gain
+        self.bend_range = bend_range if bend_range is not None else defaults.DEFAULT_AUTOMATION['bend_range']
+        self.attack = max(1, int(adsr['attack'] * defaults.SAMPLE_RATE))
+        self.decay = max(1, int(adsr['decay'] * defaults.SAMPLE_RATE))
+        self.sustain = adsr['sustain']
+        self.release = max(1, int(adsr['release'] * defaults.SAMPLE_RATE))
+        self.fade = max(1, int(defaults.STEAL_FADE * defaults.SAMPLE_RATE))
+        self.voices = voices['max_polyphony']
+        self.manager = VoiceManager(voices['max_polyphony'], voices['steal'])
+        ## per-voice state, preallocated ; slot voice + max_polyphony holds the note a voice had when it was
+        ## taken, which fades out over STEAL_FADE (as a stolen note in midi.render_notes) while the new note starts
+        n = 2 * voices['max_polyphony']
+        self.pool = VoicePool(n, block_size)
+        self.active = np.zeros(n, dtype = bool)
+        self.age = np.zeros(n, dtype = np.int64)
+        self.released_at = np.full(n, -1, dtype = np.int64)
+        self.release_level = np.zeros(n)
+        self.level = np.zeros(n, dtype = np.float32)
+        self.freq = np.zeros((n, len(self.osc)))
+        self.phase = np.zeros((n, len(self.osc)))
+        self.fade_left = np.zeros(n, dtype = np.int64)
+        ## controllers
+        self.bend = 0.0
+        self.controls = {'volume': 100 / 127.0, 'expression': 1.0}
+        ## scheduled events : (sample, order, message), and the number of samples rendered
+        self.events = []
+        self.order = 0
+        self.clock = 0
+        self.position = 0
+        self.late = 0
+        self.clipped = 0
+
+    # queues a message to be applied at a sample ; samples already rendered are applied at the next one
+    def schedule(self, msg, sample):
+        if sample < self.clock:
+            self.late += 1
+            sample = self.clock
+        heapq.heappush(self.events, (int(sample), self.order, msg))
+        self.order += 1
+
+    # renders the next block (block_size samples by default), applying its events on their sample
+    ## returns (audio, [(offset in the block, message), ...]) for the events applied
+    def render(self, frames = None):
+        frames = frames or self.block_size
+        out = np.zeros(frames, dtype = np.float32)
+        applied = []
+        pos = 0
+        while pos < frames:
+            stop = frames
+            if self.events and self.events[0][0] < self.clock + frames:
+                stop = max(pos, self.events[0][0] - self.clock)
+            if stop > pos:
+                self.render_segment(out[pos:stop])
+                pos = stop
+            self.position = pos
+            while self.events and self.events[0][0] <= self.clock + pos and pos < frames:
+                _, _, msg = heapq.heappop(self.events)
+                self.apply(msg)
+                applied.append((pos, msg))
+        self.clock += frames
+        out *= self.gain
+        over = np.abs(out) > 1.0
+        if over.any():
+            self.clipped += int(np.count_nonzero(over))
+            np.clip(out, -1.0, 1.0, out = out)
+        return out, applied
+
+    # applies a note or controller message at the current sample (self.position in the block)
+    def apply(self, msg):
+        time = self.clock + self.position
+        if msg.type == 'note_on' and msg.velocity > 0:
+            voice, _ = self.manager.note_on(msg.note, msg.velocity, time)
+            if self.active[voice]:
+                self.fade_out(voice)
+            self.active[voice] = True
+            self.age[voice] = 0
+            self.released_at[voice] = -1
+            self.level[voice] = msg.velocity / 127.0
+            self.freq[voice] = [440.0 * 2 ** ((msg.note - 69 + o.get('pitch', 0)) / 12) for o in self.osc]
+            self.phase[voice] = 0.0
+        elif msg.type == 'note_off' or msg.type == 'note_on':
+            for voice in self.manager.note_off(msg.note, time, self.release):
+                self.release_level[voice] = self.held_envelope(self.age[voice:voice + 1])[0]
+                self.released_at[voice] = self.age[voice]
+        elif msg.type == 'pitchwheel':
+            self.bend = msg.pitch / 8192.0 * self.bend_range
+        elif msg.type == 'control_change' and CC_NAMES.get(msg.control) in self.controls:
+            self.controls[CC_NAMES[msg.control]] = msg.value / 127.0
+
+    # moves the note of a voice to its fading slot, where it fades out from the current sample
+    def fade_out(self, voice):
+        slot = voice + self.voices
+        for state in (self.active, self.age, self.released_at, self.release_level, self.level, self.freq, self.phase):
+            state[slot] = state[voice]
+        self.fade_left[slot] = self.fade
+
+    # envelope of held voices at the given ages (samples since note on)
+    def held_envelope(self, ages):
+        a, d = self.attack, self.decay
+        return np.interp(ages, [0, a, a + d], [0.0, 1.0, self.sustain])
+
+    def render_segment(self, out):
+        n = len(out)
+        ratio = 2.0 ** (self.bend / 12.0)
+        gain = self.controls['volume'] * self.controls['expression']
+        steps = np.arange(n)
+        for voice in np.flatnonzero(self.active):
+            ages = self.age[voice] + steps
+            if self.released_at[voice] < 0:
+                env = self.held_envelope(ages)
+            else:
+                since = ages - self.released_at[voice]
+                env = self.release_level[voice] * np.maximum(0.0, 1.0 - since / self.release)
+            wave = self.pool.buffer(voice, n)
+            for k, o in enumerate(self.osc):
+                inc = 2 * np.pi * self.freq[voice, k] * ratio / defaults.SAMPLE_RATE
+                wave += waveform.generate_waveform_phase(self.phase[voice, k] + inc * steps, o.get('waveform')) * o.get('volume', 1.0)
+                self.phase[voice, k] = math.fmod(self.phase[voice, k] + inc * n, 2 * np.pi)
+            if voice >= self.voices:
+                env = env * np.clip((self.fade_left[voice] - steps) / self.fade, 0.0, 1.0)
+                self.fade_left[voice] -= n
+            wave *= env
+            out += wave * (self.level[voice] * gain)
+            self.age[voice] += n
+            ## the release or the fade is over : the slot is free again
+            if self.released_at[voice] >= 0 and self.age[voice] - self.released_at[voice] >= self.release:
+                self.active[voice] = False
+            if voice >= self.voices and self.fade_left[voice] <= 0:
+                self.active[voice] = False
+
+# input-to-output latency of the events, in seconds
+class LatencyStats:
+    def __init__(self):
+        self.values = []
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def summary(self):
+        if not self.values:
+            return {'count': 0}
+        v = np.array(self.values)
+        return {
+            'count': len(v),
+            'mean': float(v.mean()),
+            'min': float(v.min()),
+            'max': float(v.max()),
+            'p95': float(np.percentile(v, 95)),
+            'jitter': float(v.std()),
+        }
+
+    def report(self):
+        s = self.summary()
+        if not s['count']:
+            return "No events"
+        return (f"{s['count']} events, latency {s['mean'] * 1000:.2f} ms (min {s['min'] * 1000:.2f}, max {s['max'] * 1000:.2f}, "
+                f"p95 {s['p95'] * 1000:.2f}), jitter {s['jitter'] * 1000:.3f} ms")
+
+# note events are the ones measured, controllers follow the same path
+def measured(msg):
+    return msg.type in ('note_on', 'note_off')
+
+# replays timestamped messages, (seconds, message) sorted by time, into an engine, without audio hardware
+## each message is scheduled delay samples after its time (default : one block), like live input
+## returns (audio, LatencyStats) ; tail : seconds rendered after the last message
+def replay(events, engine, delay = None, tail = 1.0):
+    delay = engine.block_size if delay is None else delay
+    stats = LatencyStats()
+    blocks = []
+    arrivals = {}
+    end = 0
+    for t, msg in events:
+        sample = int(round(t * defaults.SAMPLE_RATE))
+        ## renders the blocks that are over before this message arrives
+        while engine.clock + engine.block_size <= sample:
+            blocks.append(render_block(engine, arrivals, stats))
+        arrivals[id(msg)] = t
+        engine.schedule(msg, sample + delay)
+        end = max(end, sample + delay)
+    end += int(tail * defaults.SAMPLE_RATE)
+    while engine.clock < end:
+        blocks.append(render_block(engine, arrivals, stats))
+    audio = np.concatenate(blocks) if blocks else np.zeros(0, dtype = np.float32)
+    return audio, stats
+
+## renders one block and measures when its events come out, on the sample clock
+def render_block(engine, arrivals, stats):
+    start = engine.clock
+    audio, applied = engine.render()
+    for offset, msg in applied:
+        if measured(msg) and id(msg) in arrivals:
+            stats.add((start + offset) / defaults.SAMPLE_RATE - arrivals.pop(id(msg)))
+    return audio
+
+# timestamped messages of a MIDI file, as (seconds, message), e.g. to replay a file as live input
+def file_events(path):
+    events, now = [], 0.0
+    for msg in mido.MidiFile(path):
+        now += msg.time
+        if not msg.is_meta and (measured(msg) or msg.type in ('pitchwheel', 'control_change')):
+            events.append((now, msg))
+    return events
+
+# live session : messages from a port (or a timed stand-in) to a sounddevice output stream
+## source : MIDI input port name, None for the default port, or an iterable of (seconds, message)
+##          played in real time from a thread, as a test stand-in for a port
+## latency : sounddevice output latency ('low', 'high' or seconds)
+## events received during a block are applied in the next one, at the sample matching their arrival
+class LiveSession:
+    def __init__(self, engine, source = None, latency = 'low', device = None):
+        self.engine = engine
+        self.source = source
+        self.latency = latency
+        self.device = device
+        self.inbox = queue.SimpleQueue()
+        self.stats = LatencyStats()
+        self.underruns = 0
+        self.stream = None
+        self.port = None
+        self.feeder = None
+        self.stopped = threading.Event()
+        self.pending = {}
+
+    ## input side : (arrival time, message), from the MIDI thread
+    def receive(self, msg):
+        self.inbox.put((time.perf_counter(), msg))
+
+    def feed(self, events):
+        start = time.perf_counter()
+        for t, msg in events:
+            wait = start + t - time.perf_counter()
+            if self.stopped.wait(max(0.0, wait)):
+                return
+            self.receive(msg)
+
+    ## output side : runs on the audio thread for every block
+    def callback(self, outdata, frames, time_info, status):
+        now = time.perf_counter()
+        if status.output_underflow:
+            self.underruns += 1
+        engine = self.engine
+        ## arrival times mapped on the sample clock : the block being rendered starts now, at engine.clock,
+        ## and an event is played one block after it arrived
+        while True:
+            try:
+                arrival, msg = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            sample = engine.clock + int(round((arrival - now) * defaults.SAMPLE_RATE)) + frames
+            engine.schedule(msg, sample)
+            self.pending[id(msg)] = arrival
+        audio, applied = engine.render(frames)
+        outdata[:, 0] = audio
+        ## time at which the first sample of this block reaches the converter, on the perf_counter clock
+        dac = now + (time_info.outputBufferDacTime - time_info.currentTime)
+        for offset, msg in applied:
+            arrival = self.pending.pop(id(msg), None)
+            if arrival is not None and measured(msg):
+                self.stats.add(dac + offset / defaults.SAMPLE_RATE - arrival)
+
+    def start(self):
+        self.stream = sd.OutputStream(samplerate = defaults.SAMPLE_RATE, blocksize = self.engine.block_size, channels = 1,
+                                      dtype = 'float32', latency = self.latency, device = self.device, callback = self.callback)
+        self.stream.start()
+        if self.source is None or isinstance(self.source, str):
+            self.port = mido.open_input(self.source, callback = self.receive)
+        else:
+            self.feeder = threading.Thread(target = self.feed, args = (self.source,), name = "pynth-live-input", daemon = True)
+            self.feeder.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.port is not None:
+            self.port.close()
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+
+    def report(self):
+        latency = self.stream.latency if self.stream is not None else None
+        parts = [self.stats.report()]
+        if latency is not None:
+            parts.append(f"stream latency {latency * 1000:.1f} ms")
+        parts.append(f"{self.underruns} underruns, {self.engine.late} late events, {self.engine.clipped} clipped samples")
+        return ", ".join(parts)
+
+# command line entry point
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pynth.live", description = "Plays pynth live from a MIDI input")
+    parser.add_argument("--list", action = "store_true", help = "lists the MIDI input ports")
+    parser.add_argument("--port", help = "MIDI input port (default: the system default)")
+    parser.add_argument("--replay", help = "plays a MIDI file as timed live input instead of a port")
+    parser.add_argument("--offline", metavar = "FLAC", help = "with --replay : renders through the block engine to a file, without audio hardware")
+    parser.add_argument("--block-size", type = int, default = DEFAULT_BLOCK_SIZE, help = "samples per block")
+    parser.add_argument("--latency", default = "low", help = "output latency : low, high or seconds")
+    parser.add_argument("--waveform", default = "sine", choices = ("sine", "saw", "square", "triangle"))
+    parser.add_argument("--polyphony", type = int, default = defaults.DEFAULT_VOICES['max_polyphony'])
+    parser.add_argument("--gain", type = float, default = DEFAULT_GAIN)
+    parser.add_argument("--duration", type = float, help = "stops after this many seconds")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name in mido.get_input_names():
+            print(name)
+        return 0
+    osc = [{'enabled': True, 'waveform': args.waveform, 'volume': 1.0, 'pitch': 0}]
+    voices = dict(defaults.DEFAULT_VOICES, max_polyphony = args.polyphony)
+    engine = LiveEngine(osc = osc, voices = voices, block_size = args.block_size, gain = args.gain)
+    source = file_events(args.replay) if args.replay else args.port
+    if args.offline:
+        if not args.replay:
+            parser.error("--offline needs --replay")
+        audio, stats = replay(source, engine)
+        sf.write(args.offline, audio, defaults.SAMPLE_RATE, format = "FLAC")
+        print(f"Rendered {len(audio) / defaults.SAMPLE_RATE:.2f} s to {args.offline} : {stats.report()}")
+        return 0
+    latency = args.latency if args.latency in ("low", "high") else float(args.latency)
+    session = LiveSession(engine, source, latency).start()
+    print("Playing, Ctrl+C to stop")
+    try:
+        if args.duration:
+            time.sleep(args.duration)
+        else:
+            while True:
+                time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.stop()
+    print(session.report())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,19 @@
 # libraries
+import io
+from functools import lru_cache
 import mido
 import numpy as np
-import soundfile as sf
 import os
 import argparse
-from . import defaults, effects, envelope, waveform, filter as flt
+from . import defaults, effects, envelope, kernels, waveform, automation as auto, filter as flt
+from .telemetry import Telemetry, NULL_TELEMETRY
+from .cancellation import check, sub_progress
+from .voices import VoicePool, limit_polyphony
+from .regions import NoteIndex, render_window
+from .lazy import lazy_import
+
+# soundfile is only needed to write FLAC files
+sf = lazy_import("soundfile")
 
 # checks if MIDI input path is correct
 def check_midi_input_path(path):
@@ -20,12 +29,24 @@ def check_flac_output(path):
         raise argparse.ArgumentTypeError("Output must be a FLAC file")
     return path
 
-# reads MIDI file to numpy audio array
-def midi_to_audio(midi_in, wf = "sine", adsr = None, fx = None, osc = None, am_lfo = None, fm_lfo = None, filters = None) : 
-    if adsr is None:
-        adsr = defaults.DEFAULT_ADSR
-    ## read the file
-    mid = mido.MidiFile(midi_in)
+# parses a MIDI file into a list of (start, end, note, velocity) tuples and the last tempo seen
+## midi_in : path, or the bytes of a MIDI file (parsed once and cached, for the render server and sweeps)
+## controls : optional list, filled with the (time, controller, value) events used for automation
+def parse_midi(midi_in, controls = None):
+    if isinstance(midi_in, (bytes, bytearray)):
+        rendered_notes, tempo, events = _parse_midi_bytes(bytes(midi_in))
+        if controls is not None:
+            controls.extend(events)
+        return list(rendered_notes), tempo
+    return _parse_midi_file(mido.MidiFile(midi_in), controls)
+
+@lru_cache(maxsize = 8)
+def _parse_midi_bytes(data):
+    events = []
+    rendered_notes, tempo = _parse_midi_file(mido.MidiFile(file = io.BytesIO(data)), events)
+    return tuple(rendered_notes), tempo, tuple(events)
+
+def _parse_midi_file(mid, controls = None):
     ## getting timing info
     tpb = mid.ticks_per_beat
     tempo = defaults.DEFAULT_TEMPO
@@ -52,98 +73,296 @@ def midi_to_audio(midi_in, wf = "sine", adsr = None, fx = None, osc = None, am_l
             if msg.note in active_notes :
                 start, velocity = active_notes.pop(msg.note)
                 rendered_notes.append((start, current_time, msg.note, velocity))
+        ### control change and pitch bend messages, for the automation curves
+        elif controls is not None:
+            event = auto.control_event(msg, current_time)
+            if event is not None:
+                controls.append(event)
+    return rendered_notes, tempo
 
-    ## if no rendered notes have been found : exit the function
-    if not rendered_notes : 
-        print("No notes found")
-        return
-    
-    ## determining total duration
+# number of samples of the rendered audio
+def audio_length(rendered_notes):
     duration = max(end for _, end, _, _ in rendered_notes)
-    audio = np.zeros(int(duration * defaults.SAMPLE_RATE), dtype=np.float32)
+    return int(duration * defaults.SAMPLE_RATE)
+
+# renders the parsed notes through the oscillators, envelope and FM LFO
+## cancel : optional cancellation.CancelToken, checked between note batches
+## progress : optional callable receiving the fraction of notes rendered
+## curves : optional control curves from automation.build_control_curves (the pitch bend is used here)
+## voices : polyphony limit and stealing policy, see defaults.DEFAULT_VOICES
+## note_voices, note_cuts : voices and steal times already given to the notes by voices.limit_polyphony, skips the allocation
+## offset, length : only renders samples [offset, offset + length) of the song, curves cover the same window
+def render_notes(rendered_notes, tempo, wf = "sine", adsr = None, osc = None, fm_lfo = None, cancel = None, progress = None, curves = None, voices = None, note_voices = None, note_cuts = None, offset = 0, length = None):
+    if adsr is None:
+        adsr = defaults.DEFAULT_ADSR
     if osc is None : 
-        osc = [{'enabled': True, 'waveform': waveform, 'volume': 1.0, 'pitch': 0}]
+        osc = [{'enabled': True, 'waveform': wf, 'volume': 1.0, 'pitch': 0}]
+    if voices is None:
+        voices = defaults.DEFAULT_VOICES
+    osc = [o for o in osc if o.get('enabled', True)]
+    ## determining total duration
+    if length is None:
+        length = audio_length(rendered_notes) - offset
+    audio = np.zeros(length, dtype=np.float32)
+    bend = curves.get('pitch_bend') if curves else None
+    fm_hz = None
+    if fm_lfo is not None and fm_lfo['enabled']:
+        bpm = 60_000_000 / tempo
+        fm_hz = bpm / 60.0 / fm_lfo['rate']
+    ## voice allocation, then each note is rendered block by block in its voice buffer
+    if note_voices is None:
+        notes, note_voices, note_cuts = limit_polyphony(rendered_notes, voices['max_polyphony'], voices['steal'])
+    else:
+        notes = rendered_notes
+    if note_cuts is None:
+        note_cuts = [None] * len(notes)
+    fade = max(1, int(defaults.STEAL_FADE * defaults.SAMPLE_RATE))
+    pool = VoicePool(voices['max_polyphony'])
+    fill = kernels.get_kernel('adsr')
+    spans = [note_span(start, end, cut, offset, length, fade) for (start, end, _, _), cut in zip(notes, note_cuts)]
+    ## progress counts the rendered samples, so long notes weigh more than short ones
+    total = sum(max(0, hi - lo) for _, _, _, lo, hi in spans)
+    done = 0
     # rendering the notes
-    for start, end, note, velocity in rendered_notes:
-        start_i = int(start * defaults.SAMPLE_RATE)
-        end_i = int(end * defaults.SAMPLE_RATE)
-        n_samples = end_i - start_i
-        t = np.linspace(0, end - start, end_i - start_i, endpoint = False)
-        ## mix oscillators
-        wave = np.zeros(n_samples, dtype = np.float32)
-        ## pre-compute FM modulator for this note (shared across oscillators)
-        fm_mod = None
-        if fm_lfo is not None and fm_lfo['enabled']:
-            bpm = 60_000_000 / tempo
-            fm_hz = bpm / 60.0 / fm_lfo['rate']
-            fm_mod = waveform.generate_waveform(fm_hz, t, fm_lfo['waveform'])
-        for o in osc : 
-            if not o.get('enabled', True):
+    for (start, end, note, velocity), voice, (start_i, n_samples, cut_k, lo, hi) in zip(notes, note_voices, spans):
+        if n_samples <= 0 or lo >= hi:
+            continue
+        ## time step of the note, as np.linspace(0, end - start, n_samples, endpoint = False)
+        step = (end - start) / n_samples
+        dt = step if n_samples > 1 else 1.0 / defaults.SAMPLE_RATE
+        freqs = [440.0 * 2 ** ((note-69 + o.get('pitch', 0)) / 12) for o in osc]
+        env = envelope.adsr_breakpoints(n_samples, adsr['attack'], adsr ['decay'], adsr['sustain'], adsr['release'])
+        ## pitch bend only when the bend moves during this note
+        bending = bend is not None and np.any(curve_slice(bend, start_i - offset, start_i + n_samples - offset))
+        ## running sums carried from block to block (FM phase deviation, bent phase)
+        fm_sum = 0.0
+        bend_sum = 0.0
+        for k0 in range(0, hi, pool.block_size):
+            check(cancel)
+            k1 = min(k0 + pool.block_size, hi)
+            t = np.arange(k0, k1) * step
+            ## blocks before the window only advance the running sums
+            if k1 <= lo:
+                if fm_hz is not None:
+                    fm_sum += np.sum(waveform.generate_waveform(fm_hz, t, fm_lfo['waveform']))
+                if bending:
+                    bend_sum += np.sum(2.0 ** (curve_slice(bend, start_i + k0 - offset, start_i + k1 - offset) / 12.0))
                 continue
-            pitch_offset = o.get('pitch', 0)
-            freq = 440.0 * 2 ** ((note-69 + pitch_offset) / 12)
-            if fm_mod is not None:
-                o_wave = waveform.generate_waveform_fm(freq, t, fm_mod, fm_lfo['depth'], o.get('waveform'))
-            else:
-                o_wave = waveform.generate_waveform(freq, t, o.get('waveform'))
-            o_wave *= o.get('volume', 1.0)
-            wave += o_wave
-        ## apply envelope
-        env = envelope.generate_adsr(n_samples, adsr['attack'], adsr ['decay'], adsr['sustain'], adsr['release'])
-        wave *= env
-        ## apply velocity
-        wave *= velocity/127.0
-        ## add it to the audio
-        audio[start_i:end_i] += wave
-    # normalize audio before effects
+            ## mix oscillators
+            wave = pool.buffer(voice, k1 - k0)
+            ## FM modulator for this block (shared across oscillators)
+            phase_dev = None
+            if fm_hz is not None:
+                fm_mod = waveform.generate_waveform(fm_hz, t, fm_lfo['waveform'])
+                fm_cum = fm_sum + np.cumsum(fm_mod)
+                fm_sum = fm_cum[-1]
+                phase_dev = 2 * np.pi * fm_lfo['depth'] * fm_cum * dt
+            bent = None
+            if bending:
+                ratio = 2.0 ** (curve_slice(bend, start_i + k0 - offset, start_i + k1 - offset) / 12.0)
+                ratio_cum = bend_sum + np.cumsum(ratio)
+                bend_sum = ratio_cum[-1]
+                ## phase at sample k integrates the frequency of the samples before it, so it starts at 0 like t
+                bent = (ratio_cum - ratio) * dt
+            for o, freq in zip(osc, freqs):
+                phase = 2 * np.pi * freq * (bent if bent is not None else t)
+                if phase_dev is not None:
+                    phase += phase_dev
+                o_wave = waveform.generate_waveform_phase(phase, o.get('waveform'))
+                o_wave *= o.get('volume', 1.0)
+                wave += o_wave
+            ## apply envelope
+            wave *= envelope.adsr_block(env, k0, k1, fill)
+            if cut_k is not None and k1 > cut_k:
+                wave *= np.clip((cut_k + fade - np.arange(k0, k1)) / fade, 0.0, 1.0)
+            ## apply velocity
+            wave *= velocity/127.0
+            ## add it to the audio
+            a = max(k0, lo)
+            audio[start_i + a - offset:start_i + k1 - offset] += wave[a - k0:]
+            done += k1 - a
+            if progress is not None:
+                progress(done / total)
+    return audio
+
+# samples of a note : (first sample, samples, steal position or None, [lo, hi) rendered in the window)
+## a stolen note keeps the envelope of the whole note and fades out from the steal
+def note_span(start, end, cut, offset, length, fade):
+    start_i = int(start * defaults.SAMPLE_RATE)
+    n_samples = int(end * defaults.SAMPLE_RATE) - start_i
+    cut_k = None if cut is None else int(cut * defaults.SAMPLE_RATE) - start_i
+    sounding = n_samples if cut_k is None else min(n_samples, cut_k + fade)
+    ## part of the note inside the rendered window
+    lo = max(0, offset - start_i)
+    hi = min(sounding, offset + length - start_i)
+    return start_i, n_samples, cut_k, lo, hi
+
+# samples [i0, i1) of a control curve, holding its first / last value outside of it
+def curve_slice(curve, i0, i1):
+    if i0 >= 0 and i1 <= len(curve):
+        return curve[i0:i1]
+    return curve[np.clip(np.arange(i0, i1), 0, len(curve) - 1)]
+
+# normalizes the audio in place to a peak of 1
+def normalize(audio):
     peak = np.max(np.abs(audio))
     if peak > 0 : audio /= peak
-    # applying the AM LFO
-    if am_lfo is not None and am_lfo['enabled']:
-        aml_amp = am_lfo['amplitude']
-        aml_rate = am_lfo['rate']
-        aml_wave = am_lfo['waveform']
-        ## get bpm value
-        bpm = 60_000_000 / tempo
-        ## turn it into herz values
-        aml_hz = bpm/60.0/aml_rate
-        ## get audio length
-        t_audio = np.arange(len(audio), dtype=np.float32) / defaults.SAMPLE_RATE
-        ## create modulator
+    return audio
+
+# applies the AM LFO
+## offset : position of the first sample in the song, so the LFO keeps its phase in a region
+def apply_am_lfo(audio, tempo, am_lfo = None, offset = 0, cancel = None):
+    if am_lfo is None or not am_lfo['enabled']:
+        return audio
+    aml_amp = am_lfo['amplitude']
+    aml_rate = am_lfo['rate']
+    aml_wave = am_lfo['waveform']
+    ## get bpm value
+    bpm = 60_000_000 / tempo
+    ## turn it into herz values
+    aml_hz = bpm/60.0/aml_rate
+    ## create the modulator and apply it block by block
+    for start, stop in effects.blocks(len(audio), cancel):
+        t_audio = np.arange(offset + start, offset + stop, dtype=np.float32) / defaults.SAMPLE_RATE
         m_wave = waveform.generate_waveform(aml_hz, t_audio, aml_wave)
         modulator = (1 - aml_amp)+ (aml_amp * (0.5 + m_wave /2.0))
-        ## apply modulator
-        audio *= modulator
-    # effects
-    if fx :
-        if 'chorus' in fx :
-            params = fx['chorus']
-            audio = effects.apply_chorus(audio, **params)
-        if 'delay' in fx :
-            params = fx['delay']
-            audio = effects.apply_delay(audio, **params)
-        if 'reverb' in fx:
-            params = fx['reverb']
-            audio = effects.apply_reverb(audio, **params)
-    # normalize audio after effects
-    peak = np.max(np.abs(audio))
-    if peak > 0 : audio /= peak
-    # applying the lowpass/highpass
+        audio[start:stop] *= modulator
+    return audio
+
+# applies the chorus, delay and reverb effects, in that order
+## curves : optional control curves, the modulation wheel pushes the mix of every effect towards wet
+## offset : position of the first sample in the song, for the chorus LFO phase
+def apply_effects(audio, fx = None, telemetry = NULL_TELEMETRY, cancel = None, progress = None, curves = None, offset = 0):
+    if not fx :
+        return audio
+    chain = [(name, fn) for name, fn in (('chorus', effects.apply_chorus), ('delay', effects.apply_delay), ('reverb', effects.apply_reverb)) if name in fx]
+    for n, (name, fn) in enumerate(chain):
+        params = fx[name]
+        if name == 'chorus' and offset:
+            params = dict(params, offset = offset)
+        mix = auto.mix_curve(curves, params.get('mix', 0.0)) if curves else None
+        with telemetry.stage(name) as st:
+            step = sub_progress(progress, n / len(chain), (n + 1) / len(chain))
+            if mix is None:
+                audio = fn(audio, cancel = cancel, progress = step, **params)
+            else:
+                wet = fn(audio, cancel = cancel, progress = step, **dict(params, mix = 1.0))
+                audio = audio * (1 - mix) + wet * mix
+            st.samples = len(audio)
+    return audio
+
+# applies the lowpass/highpass
+## curves : optional control curves, the brightness controller moves the lowpass cutoff
+## cancel : optional cancellation.CancelToken, checked between filter blocks
+def apply_filters(audio, filters = None, curves = None, automation = None, cancel = None):
+    if not filters :
+        return audio
     lp = filters.get('lowpass',  {})
     hp = filters.get('highpass', {})
     if hp.get('enabled') and lp.get('enabled'):
         if hp['cutoff'] >= lp['cutoff']:  # degenerate — skip both
             pass
         else:
-            audio = flt.apply_highpass(audio, hp['cutoff'], int(hp['order']))
-            audio = flt.apply_lowpass(audio,  lp['cutoff'], int(lp['order']))
+            audio = flt.apply_highpass(audio, hp['cutoff'], int(hp['order']), cancel)
+            audio = _lowpass(audio, lp, curves, automation, cancel)
     else:
         if hp.get('enabled'):
-            audio = flt.apply_highpass(audio, hp['cutoff'], int(hp['order']))
+            audio = flt.apply_highpass(audio, hp['cutoff'], int(hp['order']), cancel)
         if lp.get('enabled'):
-            audio = flt.apply_lowpass(audio,  lp['cutoff'], int(lp['order']))
+            audio = _lowpass(audio, lp, curves, automation, cancel)
+    return audio
+
+def _lowpass(audio, lp, curves, automation, cancel = None):
+    cutoff = auto.cutoff_curve(curves, lp['cutoff'], automation) if curves else None
+    if cutoff is not None:
+        return flt.apply_lowpass_modulated(audio, cutoff, int(lp['order']), cancel)
+    return flt.apply_lowpass(audio,  lp['cutoff'], int(lp['order']), cancel)
+
+# picks the telemetry for a render : a real one only when profiling or observing
+def make_telemetry(profile = False, observer = None, track_memory = True):
+    if profile or observer is not None:
+        return Telemetry(observer = observer, track_memory = track_memory)
+    return NULL_TELEMETRY
+
+# reads MIDI file to numpy audio array
+## profile : also returns a telemetry.RenderReport, as (audio, rendered_notes, report)
+## observer : optional callable receiving a telemetry.StageStats when each stage starts and finishes
+## telemetry : a telemetry.Telemetry to record into, e.g. to skip the (slow) memory tracking
+## progress : optional callable receiving the overall progress, from 0 to 1
+## cancel : optional cancellation.CancelToken ; a cancelled render raises cancellation.RenderCancelled
+## automation : CC / pitch bend settings, see defaults.DEFAULT_AUTOMATION
+## voices : polyphony limit and stealing policy, see defaults.DEFAULT_VOICES
+## region : optional (start, end) in seconds ; only the notes sounding in the region are rendered,
+##          after a pre-roll long enough for the effect tails, and the audio is normalized on the region
+def midi_to_audio(midi_in, wf = "sine", adsr = None, fx = None, osc = None, am_lfo = None, fm_lfo = None, filters = None, profile = False, observer = None, telemetry = None, progress = None, cancel = None, automation = None, voices = None, region = None) : 
+    if automation is None:
+        automation = defaults.DEFAULT_AUTOMATION
+    if voices is None:
+        voices = defaults.DEFAULT_VOICES
+    tel = telemetry if telemetry is not None else make_telemetry(profile, observer)
+    controls = [] if automation['enabled'] else None
+    with tel.stage('parse'):
+        rendered_notes, tempo = parse_midi(midi_in, controls)
+
+    ## if no rendered notes have been found : exit the function
+    if not rendered_notes : 
+        print("No notes found")
+        return (None, rendered_notes, tel.report) if profile else (None, rendered_notes)
+    
+    # region : selects the notes sounding in the rendered window
+    offset, length, skip, region_length = 0, audio_length(rendered_notes), 0, None
+    note_voices = note_cuts = None
+    if region is not None:
+        with tel.stage('region'):
+            offset, length, skip, region_length = render_window(region, length, fx, filters)
+            ## voices are allocated on the whole song, so stealing matches a full render
+            rendered_notes, note_voices, note_cuts = limit_polyphony(rendered_notes, voices['max_polyphony'], voices['steal'])
+            selected = NoteIndex(rendered_notes).query(offset / defaults.SAMPLE_RATE, (offset + length) / defaults.SAMPLE_RATE)
+            rendered_notes = [rendered_notes[i] for i in selected]
+            note_voices = [note_voices[i] for i in selected]
+            note_cuts = [note_cuts[i] for i in selected]
+    # control curves, computed once for the whole render
+    curves = {}
+    if controls:
+        with tel.stage('automation') as st:
+            st.samples = length
+            curves = auto.build_control_curves(controls, length, automation, offset)
+    with tel.stage('synth') as st:
+        audio = render_notes(rendered_notes, tempo, wf = wf, adsr = adsr, osc = osc, fm_lfo = fm_lfo, cancel = cancel, progress = sub_progress(progress, 0.0, 0.4), curves = curves, voices = voices, note_voices = note_voices, note_cuts = note_cuts, offset = offset, length = length)
+        ## volume and expression controllers
+        gain = auto.gain_curve(curves)
+        if gain is not None:
+            audio *= gain
+        # normalize audio before effects
+        audio = normalize(audio)
+        st.samples = len(audio)
+    # applying the AM LFO
+    if am_lfo is not None and am_lfo['enabled']:
+        check(cancel)
+        with tel.stage('am') as st:
+            audio = apply_am_lfo(audio, tempo, am_lfo, offset, cancel)
+            st.samples = len(audio)
+    # effects
+    audio = apply_effects(audio, fx, tel, cancel = cancel, progress = sub_progress(progress, 0.45, 0.9), curves = curves, offset = offset)
+    # normalize audio after effects
+    audio = normalize(audio)
+    # applying the lowpass/highpass
+    if filters:
+        check(cancel)
+        with tel.stage('filters') as st:
+            audio = apply_filters(audio, filters, curves, automation, cancel)
+            st.samples = len(audio)
+    # drops the pre-roll and the filter margin of a region
+    if region_length is not None:
+        audio = audio[skip:skip + region_length].copy()
 
     # return the final audio
+    if progress is not None:
+        progress(1.0)
+    if tel.enabled:
+        tel.report.audio_samples = len(audio)
+    if profile:
+        return audio, rendered_notes, tel.report
     return audio, rendered_notes
 
 ## write to file
@@ -155,9 +374,15 @@ def audio_to_flac(audio, file_out):
     print(f"Rendered MIDI to {file_out}, containing {len(audio)} samples")
 
 ## high level function
-def midi_to_flac(midi_in, file_out, wf="sine", adsr = None, fx = None, osc = None, am_lfo = None, fm_lfo = None, filters = None) : 
-    audio, rendered_notes = midi_to_audio(midi_in, wf = wf, adsr = adsr, fx = fx, osc = osc, am_lfo = am_lfo, fm_lfo = fm_lfo, filters = filters)
+## profile : returns the telemetry.RenderReport of the render, FLAC encoding included
+def midi_to_flac(midi_in, file_out, wf="sine", adsr = None, fx = None, osc = None, am_lfo = None, fm_lfo = None, filters = None, profile = False, observer = None, telemetry = None, progress = None, cancel = None, automation = None, voices = None, region = None) : 
+    tel = telemetry if telemetry is not None else make_telemetry(profile, observer)
+    audio, rendered_notes = midi_to_audio(midi_in, wf = wf, adsr = adsr, fx = fx, osc = osc, am_lfo = am_lfo, fm_lfo = fm_lfo, filters = filters, telemetry = tel, progress = progress, cancel = cancel, automation = automation, voices = voices, region = region)
     if audio is None : 
-        return
-    audio_to_flac(audio, file_out)
-    print(f"File rendered to {file_out} with {len(rendered_notes)} notes")
\ No newline at end of file
+        return tel.report
+    check(cancel)
+    with tel.stage('flac') as st:
+        audio_to_flac(audio, file_out)
+        st.samples = len(audio)
+    print(f"File rendered to {file_out} with {len(rendered_notes)} notes")
+    return tel.report
@@ -0,0 +1,213 @@
+# libraries
+import numpy as np
+from . import defaults
+
+# overview of a render, for drawing : min/max peaks and a coarse spectrogram
+## both are built once, block by block, while or after the audio is rendered ; drawing a view of any
+## zoom level then only reads a few thousand values, never the samples themselves
+
+# samples per bucket of the finest peak level, and buckets merged per level above it
+PEAK_BASE = 64
+PEAK_FACTOR = 4
+# spectrogram : FFT size (one frame per FFT size, no overlap), number of log-spaced bands, lowest band
+SPEC_FFT = 2048
+SPEC_BANDS = 96
+SPEC_F_MIN = 30.0
+# floor of the spectrogram, in dB
+SPEC_FLOOR = -120.0
+# level above which a sample is shown as clipping (the export is 16-bit)
+CLIP_LEVEL = 1.0
+# levels shown by the spectrum view, below its loudest band, in dB
+SPEC_RANGE = 90.0
+# spectrum colours, from silent to loud
+PALETTE = [(0, 0, 0), (40, 10, 90), (150, 30, 110), (240, 110, 40), (255, 230, 120)]
+
+# array that grows by doubling, so appending block by block stays linear
+class Growable:
+    def __init__(self, width = None, dtype = np.float32):
+        shape = (1024,) if width is None else (1024, width)
+        self.data = np.empty(shape, dtype = dtype)
+        self.size = 0
+
+    def extend(self, values):
+        n = len(values)
+        if self.size + n > len(self.data):
+            grown = np.empty((max(2 * len(self.data), self.size + n),) + self.data.shape[1:], dtype = self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+# indices reducing n values to width columns : (reduceat starts) when n >= width, else (repeat indices)
+def columns(n, width):
+    if n >= width:
+        return np.linspace(0, n, width + 1).astype(np.int64)[:-1], None
+    return None, (np.arange(width) * n) // width
+
+def reduce_columns(values, width, ufunc):
+    starts, repeat = columns(len(values), width)
+    if repeat is not None:
+        return values[repeat]
+    return ufunc.reduceat(values, starts, axis = 0)
+
+# min/max pyramid : level k holds the min and max of every PEAK_BASE * PEAK_FACTOR ** k samples
+## the last, incomplete bucket of each level is computed when a view needs it
+class PeakPyramid:
+    def __init__(self, base = PEAK_BASE, factor = PEAK_FACTOR, levels = 10):
+        self.base = base
+        self.factor = factor
+        self.mins = [Growable() for _ in range(levels)]
+        self.maxs = [Growable() for _ in range(levels)]
+        self.tail = np.empty(0, dtype = np.float32)
+        self.length = 0
+        self.peak = 0.0
+        self.clipped = 0
+
+    def bucket(self, level):
+        return self.base * self.factor ** level
+
+    def append(self, block):
+        block = np.asarray(block, dtype = np.float32)
+        if len(block) == 0:
+            return
+        self.length += len(block)
+        self.peak = max(self.peak, float(np.max(np.abs(block))))
+        self.clipped += int(np.count_nonzero(np.abs(block) > CLIP_LEVEL))
+        data = np.concatenate([self.tail, block]) if len(self.tail) else block
+        full = len(data) // self.base * self.base
+        self.tail = data[full:].copy()
+        if not full:
+            return
+        frames = data[:full].reshape(-1, self.base)
+        self.mins[0].extend(frames.min(axis = 1))
+        self.maxs[0].extend(frames.max(axis = 1))
+        ## complete groups of the level below move up, level by level
+        for k in range(1, len(self.mins)):
+            below = self.mins[k - 1].size // self.factor
+            if below <= self.mins[k].size:
+                break
+            lo, hi = self.mins[k].size * self.factor, below * self.factor
+            self.mins[k].extend(self.mins[k - 1].values[lo:hi].reshape(-1, self.factor).min(axis = 1))
+            self.maxs[k].extend(self.maxs[k - 1].values[lo:hi].reshape(-1, self.factor).max(axis = 1))
+
+    ## (min, max) of the incomplete bucket at the end of a level, or None
+    def pending(self, level):
+        if level == 0:
+            if not len(self.tail):
+                return None
+            return float(self.tail.min()), float(self.tail.max())
+        rest = slice(self.mins[level].size * self.factor, self.mins[level - 1].size)
+        lo, hi = list(self.mins[level - 1].values[rest]), list(self.maxs[level - 1].values[rest])
+        below = self.pending(level - 1)
+        if below is not None:
+            lo.append(below[0])
+            hi.append(below[1])
+        if not lo:
+            return None
+        return min(lo), max(hi)
+
+    # (mins, maxs) of samples [start, stop), as width columns
+    ## uses the coarsest level that still has a bucket per column
+    def view(self, start, stop, width):
+        start, stop = max(0, int(start)), min(self.length, int(stop))
+        if stop <= start or width <= 0:
+            return np.zeros(0, dtype = np.float32), np.zeros(0, dtype = np.float32)
+        level = 0
+        while level + 1 < len(self.mins) and (stop - start) / self.bucket(level + 1) >= width:
+            level += 1
+        size = self.bucket(level)
+        i0, i1 = start // size, -(-stop // size)
+        mins, maxs = self.mins[level].values[i0:i1], self.maxs[level].values[i0:i1]
+        if i1 > self.mins[level].size:
+            pending = self.pending(level)
+            if pending is not None:
+                mins = np.append(mins, np.float32(pending[0]))
+                maxs = np.append(maxs, np.float32(pending[1]))
+        return reduce_columns(mins, width, np.minimum), reduce_columns(maxs, width, np.maximum)
+
+# coarse spectrogram : one frame per SPEC_FFT samples, power pooled into log-spaced bands, in dB
+class Spectrogram:
+    def __init__(self, n_fft = SPEC_FFT, bands = SPEC_BANDS, f_min = SPEC_F_MIN):
+        self.n_fft = n_fft
+        self.window = np.hanning(n_fft).astype(np.float32)
+        freqs = np.fft.rfftfreq(n_fft, 1.0 / defaults.SAMPLE_RATE)
+        edges = np.geomspace(f_min, defaults.SAMPLE_RATE / 2, bands + 1)[:-1]
+        ## first FFT bin of each band ; low bands narrower than a bin are merged
+        self.starts = np.unique(np.clip(np.searchsorted(freqs, edges), 1, len(freqs) - 1))
+        self.freqs = freqs[self.starts]
+        self.frames = Growable(len(self.starts))
+        self.tail = np.empty(0, dtype = np.float32)
+        self.length = 0
+
+    @property
+    def bands(self):
+        return len(self.starts)
+
+    def append(self, block):
+        block = np.asarray(block, dtype = np.float32)
+        self.length += len(block)
+        data = np.concatenate([self.tail, block]) if len(self.tail) else block
+        full = len(data) // self.n_fft * self.n_fft
+        self.tail = data[full:].copy()
+        if not full:
+            return
+        frames = data[:full].reshape(-1, self.n_fft) * self.window
+        power = np.abs(np.fft.rfft(frames, axis = 1)) ** 2
+        bands = np.add.reduceat(power, self.starts, axis = 1) / np.diff(np.append(self.starts, power.shape[1]))
+        self.frames.extend((10.0 * np.log10(bands + 1e-20)).astype(np.float32))
+
+    # band levels in dB of samples [start, stop), as an array of (bands, width), lowest band first
+    ## frames are merged by their maximum, so short events stay visible when zoomed out
+    def view(self, start, stop, width):
+        i0 = max(0, int(start) // self.n_fft)
+        i1 = min(self.frames.size, -(-int(stop) // self.n_fft))
+        if i1 <= i0 or width <= 0:
+            return np.full((self.bands, 0), SPEC_FLOOR, dtype = np.float32)
+        return np.maximum(reduce_columns(self.frames.values[i0:i1], width, np.maximum), SPEC_FLOOR).T
+
+# peaks and spectrogram of a render
+class Overview:
+    def __init__(self):
+        self.peaks = PeakPyramid()
+        self.spectrum = Spectrogram()
+
+    @property
+    def length(self):
+        return self.peaks.length
+
+    @property
+    def duration(self):
+        return self.length / defaults.SAMPLE_RATE
+
+    def append(self, block):
+        self.peaks.append(block)
+        self.spectrum.append(block)
+
+def from_audio(audio, block_size = 1 << 16):
+    overview = Overview()
+    for start in range(0, len(audio), block_size):
+        overview.append(audio[start:start + block_size])
+    return overview
+
+# Tk image data ("{#rrggbb ...} {...}", one group per row) of a spectrum view, stretched to height rows
+## highest band on top ; levels are shown over SPEC_RANGE dB below the loudest one of the view
+def spectrum_image(levels, height, dynamic_range = SPEC_RANGE):
+    bands, width = levels.shape
+    if not width or height <= 0:
+        return ""
+    top = float(levels.max())
+    shade = np.clip((levels - (top - dynamic_range)) / dynamic_range, 0.0, 1.0)
+    index = (shade * 255).astype(np.int64)
+    rows = index[bands - 1 - (np.arange(height) * bands) // height]
+    return " ".join("{" + " ".join(row) + "}" for row in palette_hex()[rows])
+
+## 256 colours interpolated from PALETTE, as Tk colour strings
+def palette_hex():
+    stops = np.linspace(0.0, 1.0, len(PALETTE))
+    x = np.linspace(0.0, 1.0, 256)
+    rgb = np.stack([np.interp(x, stops, [c[i] for c in PALETTE]) for i in range(3)], axis = 1).astype(int)
+    return np.array([f"#{r:02x}{g:02x}{b:02x}" for r, g, b in rgb])
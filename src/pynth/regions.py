@@ -0,0 +1,67 @@
+# libraries
+import math
+import numpy as np
+from . import defaults
+
+# margin rendered on each side of a region for the zero-phase filters to settle
+FILTER_MARGIN = 0.05
+# longest delay tail taken into account, for feedback values close to 1
+MAX_DELAY_TAIL = 20.0
+
+# interval index over the parsed notes : starts sorted, with the running maximum of the ends
+## a query only scans the notes between the first one that can still sound and the last one already started
+class NoteIndex:
+    def __init__(self, rendered_notes):
+        starts = np.array([n[0] for n in rendered_notes], dtype = np.float64)
+        ends = np.array([n[1] for n in rendered_notes], dtype = np.float64)
+        self.order = np.argsort(starts, kind = 'stable')
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        self.max_end = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+    # indices (in the original note list, in order) of the notes sounding in [t0, t1)
+    ## tail : extra time a note keeps sounding after its end (e.g. a release outside of the note)
+    def query(self, t0, t1, tail = 0.0):
+        hi = np.searchsorted(self.starts, t1, side = 'left')
+        lo = np.searchsorted(self.max_end + tail, t0, side = 'right')
+        if lo >= hi:
+            return np.array([], dtype = np.int64)
+        candidates = np.arange(lo, hi)
+        candidates = candidates[self.ends[candidates] + tail > t0]
+        return np.sort(self.order[candidates])
+
+# how long each effect keeps sounding after its input stops, in seconds
+def effect_tail(name, params):
+    if name == 'chorus':
+        return 2 * params.get('depth', 0.002)
+    if name == 'delay':
+        feedback = abs(params.get('feedback', 0.5))
+        if feedback <= 0:
+            return params.get('delay_time', 0.3)
+        if feedback >= 1:
+            return MAX_DELAY_TAIL
+        ## echoes until they fall under -60 dB
+        echoes = math.ceil(math.log(1e-3) / math.log(feedback))
+        return min(MAX_DELAY_TAIL, echoes * params.get('delay_time', 0.3))
+    if name == 'reverb':
+        return 0.5 + params.get('room_size', 0.5) * 2.0
+    return 0.0
+
+# pre-roll needed for the effect chain to be in the right state at the start of a region
+def preroll(fx = None, filters = None):
+    total = sum(effect_tail(name, params) for name, params in (fx or {}).items())
+    if filters:
+        total += FILTER_MARGIN
+    return total
+
+# sample window to render for a region : (first sample, number of samples, samples to skip, region samples)
+## the window starts pre-roll seconds before the region and ends after the filter margin
+def render_window(region, song_length, fx = None, filters = None):
+    t0, t1 = region
+    start = int(max(0.0, t0) * defaults.SAMPLE_RATE)
+    stop = int(min(song_length, t1 * defaults.SAMPLE_RATE))
+    if stop <= start:
+        raise ValueError(f"Empty region : {t0} - {t1}")
+    first = max(0, start - int(preroll(fx, filters) * defaults.SAMPLE_RATE))
+    last = min(song_length, stop + (int(FILTER_MARGIN * defaults.SAMPLE_RATE) if filters else 0))
+    return first, last - first, start - first, stop - start
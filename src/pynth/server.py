@@ -0,0 +1,496 @@
+# libraries
+import argparse
+import asyncio
+import http.client
+import io
+import itertools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import defaults
+from .lazy import warm_up
+
+# local render server : MIDI bytes in, FLAC bytes out, over localhost HTTP or a Unix socket
+## jobs wait in a priority queue and run on a pool of worker processes started once ; each worker keeps
+## its caches (parsed MIDI, reverb impulse responses, filter designs) from one job to the next
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# largest MIDI file accepted, in bytes
+MAX_BODY = 16 * 2**20
+# size of the chunks the FLAC data is streamed back in
+CHUNK_SIZE = 64 * 1024
+# parameters a job may set, passed as is to midi.midi_to_audio
+RENDER_PARAMS = ('wf', 'adsr', 'fx', 'osc', 'am_lfo', 'fm_lfo', 'filters', 'automation', 'voices', 'region')
+# modules imported by every worker before its first job
+WORKER_MODULES = ["numpy", "mido", "scipy.signal", "scipy.fft", "soundfile", "pynth.midi"]
+
+# worker side
+## runs once in each worker process
+def init_worker():
+    from . import kernels
+    warm_up(WORKER_MODULES + [kernels.prepare], background = False)
+
+## renders one job, returns (FLAC bytes, number of notes, render report as a dict)
+def render_job(data, params):
+    import soundfile as sf
+    from . import midi
+    from .telemetry import Telemetry
+    tel = Telemetry(track_memory = False)
+    audio, notes = midi.midi_to_audio(data, telemetry = tel, **params)
+    if audio is None:
+        return b"", 0, tel.report.to_dict()
+    with tel.stage('flac') as st:
+        buf = io.BytesIO()
+        sf.write(buf, audio, defaults.SAMPLE_RATE, format = "FLAC")
+        st.samples = len(audio)
+    return buf.getvalue(), len(notes), tel.report.to_dict()
+
+## small job used to start every worker and fill its caches before the first request
+def warm_job(_):
+    init_worker()
+    return os.getpid()
+
+# checks of the parameter values : a job can't allocate or run without bounds
+## number(lo, hi) and choice(...) check one value ; a dict checks an object, key by key ; a list [spec, n] checks
+## a list of at most n objects ; objects in REQUIRED_PARAMS must have every key (the renderer reads them all),
+## the others may leave keys out
+def number(lo, hi, integer = False):
+    def validate(path, value):
+        kind = int if integer else (int, float)
+        if isinstance(value, bool) or not isinstance(value, kind):
+            raise ValueError(f"{path} must be {'an integer' if integer else 'a number'}")
+        if not lo <= value <= hi:
+            raise ValueError(f"{path} must be between {lo} and {hi}")
+        return value
+    return validate
+
+def choice(*values):
+    def validate(path, value):
+        if value not in values:
+            raise ValueError(f"{path} must be one of {', '.join(map(str, values))}")
+        return value
+    return validate
+
+FLAG = choice(True, False)
+WAVEFORM = choice(*defaults.WAVEFORMS)
+LEVEL = number(0.0, 1.0)
+FILTER_PARAMS = {'enabled': FLAG, 'cutoff': number(20.0, defaults.SAMPLE_RATE / 2), 'order': number(1, 8, integer = True)}
+PARAM_LIMITS = {
+    'wf': WAVEFORM,
+    'adsr': {'attack': number(0.0, 10.0), 'decay': number(0.0, 10.0), 'sustain': LEVEL, 'release': number(0.0, 10.0)},
+    'fx': {
+        'chorus': {'rate': number(0.0, 20.0), 'depth': number(0.0, 0.05), 'mix': LEVEL},
+        'delay': {'delay_time': number(0.0, 5.0), 'feedback': LEVEL, 'mix': LEVEL},
+        'reverb': {'room_size': LEVEL, 'damping': LEVEL, 'mix': LEVEL},
+    },
+    'osc': [{'enabled': FLAG, 'waveform': WAVEFORM, 'volume': number(0.0, 2.0), 'pitch': number(-48, 48)}, 8],
+    'am_lfo': {'enabled': FLAG, 'rate': number(1 / 256, 16.0), 'amplitude': LEVEL, 'waveform': WAVEFORM},
+    'fm_lfo': {'enabled': FLAG, 'rate': number(1 / 256, 16.0), 'depth': number(0.0, 1000.0), 'waveform': WAVEFORM},
+    'filters': {'lowpass': FILTER_PARAMS, 'highpass': FILTER_PARAMS},
+    'automation': {'enabled': FLAG, 'smoothing': number(0.0, 1.0), 'bend_range': number(0.0, 48.0), 'brightness_range': number(0.0, 8.0)},
+    'voices': {'max_polyphony': number(1, 256, integer = True), 'steal': choice(*defaults.STEAL_POLICIES)},
+}
+REQUIRED_PARAMS = ('adsr', 'am_lfo', 'fm_lfo', 'automation', 'voices', 'filters.lowpass', 'filters.highpass')
+
+def check_value(path, value, spec):
+    if callable(spec):
+        return spec(path, value)
+    if isinstance(spec, list):
+        item, most = spec
+        if not isinstance(value, list) or len(value) > most:
+            raise ValueError(f"{path} must be a list of at most {most} objects")
+        return [check_value(f"{path}[{i}]", v, item) for i, v in enumerate(value)]
+    if not isinstance(value, dict):
+        raise ValueError(f"{path} must be an object")
+    unknown = sorted(set(value) - set(spec))
+    if unknown:
+        raise ValueError(f"Unknown parameters in {path} : {', '.join(unknown)}")
+    if path in REQUIRED_PARAMS:
+        missing = [k for k in spec if k not in value]
+        if missing:
+            raise ValueError(f"Missing parameters in {path} : {', '.join(missing)}")
+    return {k: check_value(f"{path}.{k}", v, spec[k]) for k, v in value.items()}
+
+# checks the parameter set of a job, raises ValueError when it can't be rendered
+## None stands for the default of a parameter
+def check_params(params):
+    if not isinstance(params, dict):
+        raise ValueError("Parameters must be a JSON object")
+    unknown = sorted(set(params) - set(RENDER_PARAMS))
+    if unknown:
+        raise ValueError(f"Unknown parameters : {', '.join(unknown)}")
+    for name, spec in PARAM_LIMITS.items():
+        if params.get(name) is not None:
+            params[name] = check_value(name, params[name], spec)
+    region = params.get('region')
+    if region is not None:
+        if not isinstance(region, (list, tuple)) or len(region) != 2:
+            raise ValueError("Region must be [start, end] in seconds")
+        start, end = (number(0.0, float('inf'))(f"region[{i}]", t) for i, t in enumerate(region))
+        if end <= start:
+            raise ValueError("Region must end after it starts")
+        params['region'] = (float(start), float(end))
+    return params
+
+# a queued render
+class Job:
+    def __init__(self, data, params, priority, future):
+        self.data = data
+        self.params = params
+        self.priority = priority
+        self.future = future
+        self.queued = time.perf_counter()
+
+# the server : queue, dispatchers and worker pool
+## workers : number of worker processes
+## concurrency : number of jobs rendering at the same time (at most the number of workers)
+## max_queue : jobs waiting beyond this are refused with 503
+class RenderServer:
+    def __init__(self, host = DEFAULT_HOST, port = DEFAULT_PORT, socket_path = None, workers = None, concurrency = None, max_queue = 64):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.concurrency = min(concurrency or self.workers, self.workers)
+        self.max_queue = max_queue
+        self.pool = None
+        self.pool_lock = None
+        self.worker_pids = []
+        self.queue = None
+        self.server = None
+        self.dispatchers = []
+        self.seq = itertools.count()
+        self.metrics = {
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'audio_seconds': 0.0,
+            'render_seconds': 0.0,
+            'wait_seconds': 0.0,
+            'last_realtime_factor': None,
+            'pool_restarts': 0,
+        }
+
+    # starts the workers and listens ; returns once the server accepts connections
+    async def start(self):
+        self.pool_lock = asyncio.Lock()
+        self.pool = await self.start_pool()
+        self.queue = asyncio.PriorityQueue()
+        self.dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.concurrency)]
+        if self.socket_path:
+            self.server = await asyncio.start_unix_server(self.handle, path = self.socket_path)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    ## starts the worker processes, with one warm-up job per worker so every process exists before the first request
+    async def start_pool(self):
+        loop = asyncio.get_running_loop()
+        pool = ProcessPoolExecutor(max_workers = self.workers, initializer = init_worker)
+        self.worker_pids = await asyncio.gather(*[loop.run_in_executor(pool, warm_job, i) for i in range(self.workers)])
+        return pool
+
+    ## replaces a pool broken by a worker that died (crash, out of memory, killed) ; the jobs it was running fail
+    async def restart_pool(self, broken):
+        async with self.pool_lock:
+            if self.pool is not broken:
+                return
+            ## a broken pool has already failed its pending jobs
+            broken.shutdown(wait = False)
+            self.pool = await self.start_pool()
+            self.metrics['pool_restarts'] += 1
+            print(f"A worker died, the pool was restarted ({self.metrics['pool_restarts']} restarts)")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for task in self.dispatchers:
+            task.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions = True)
+        ## cancelling a dispatcher cancels the pool job it was waiting for, unless it is already running
+        if self.pool is not None:
+            self.pool.shutdown(wait = True)
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def serve_forever(self):
+        await self.start()
+        where = self.socket_path or f"http://{self.host}:{self.port}"
+        print(f"pynth render server on {where} ({self.workers} workers, {self.concurrency} concurrent jobs)")
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    # queues a job, lower priorities run first ; returns (FLAC bytes, notes, report)
+    async def submit(self, data, params, priority = 0):
+        if self.queue.qsize() >= self.max_queue:
+            self.metrics['rejected'] += 1
+            raise QueueFull()
+        job = Job(data, params, priority, asyncio.get_running_loop().create_future())
+        self.queue.put_nowait((priority, next(self.seq), job))
+        return await job.future
+
+    ## takes jobs from the queue, one at a time, and runs them on the pool
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self.queue.get()
+            ## the client went away while the job was waiting
+            if job.future.done():
+                continue
+            self.metrics['running'] += 1
+            self.metrics['wait_seconds'] += time.perf_counter() - job.queued
+            start = time.perf_counter()
+            pool = self.pool
+            try:
+                ## waits for a pool being restarted
+                async with self.pool_lock:
+                    pool = self.pool
+                result = await loop.run_in_executor(pool, render_job, job.data, job.params)
+            except BrokenProcessPool as e:
+                self.metrics['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                await self.restart_pool(pool)
+            except Exception as e:
+                self.metrics['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.record(result[2], time.perf_counter() - start)
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.metrics['running'] -= 1
+
+    ## keeps the totals behind the realtime factor
+    def record(self, report, seconds):
+        audio_seconds = report['audio_samples'] / defaults.SAMPLE_RATE
+        self.metrics['completed'] += 1
+        self.metrics['audio_seconds'] += audio_seconds
+        self.metrics['render_seconds'] += seconds
+        self.metrics['last_realtime_factor'] = audio_seconds / seconds if seconds > 0 else None
+
+    # metrics endpoint
+    ## realtime_factor : seconds of audio per second of job time (queue excluded), over all jobs
+    def snapshot(self):
+        m = dict(self.metrics)
+        m['queue_depth'] = self.queue.qsize() if self.queue is not None else 0
+        m['workers'] = self.workers
+        m['concurrency'] = self.concurrency
+        m['max_queue'] = self.max_queue
+        m['realtime_factor'] = m['audio_seconds'] / m['render_seconds'] if m['render_seconds'] > 0 else None
+        return m
+
+    # HTTP/1.1, one request per connection
+    async def handle(self, reader, writer):
+        try:
+            method, path, headers, body = await read_request(reader)
+            await self.route(method, path, headers, body, writer)
+        except HTTPError as e:
+            await send_json(writer, e.status, {'error': e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def route(self, method, path, headers, body, writer):
+        path = path.split("?", 1)[0]
+        if path == "/health" and method == "GET":
+            return await send_json(writer, 200, {'status': 'ok'})
+        if path == "/metrics" and method == "GET":
+            return await send_json(writer, 200, self.snapshot())
+        if path != "/render":
+            raise HTTPError(404, f"Unknown path : {path}")
+        if method != "POST":
+            raise HTTPError(405, "Use POST to render")
+        if not body:
+            raise HTTPError(400, "Missing MIDI data")
+        try:
+            params = check_params(json.loads(headers.get('x-pynth-params', '{}')))
+            priority = int(headers.get('x-pynth-priority', 0))
+        except (ValueError, TypeError) as e:
+            raise HTTPError(400, str(e))
+        start = time.perf_counter()
+        try:
+            flac, notes, report = await self.submit(body, params, priority)
+        except QueueFull:
+            raise HTTPError(503, "Queue full")
+        ## valid parameters the song can't be rendered with (e.g. a region after its end)
+        except ValueError as e:
+            raise HTTPError(422, str(e))
+        except Exception as e:
+            raise HTTPError(500, f"{type(e).__name__} : {e}")
+        if not flac:
+            raise HTTPError(422, "No notes found")
+        await send_stream(writer, flac, {
+            'Content-Type': 'audio/flac',
+            'X-Pynth-Notes': str(notes),
+            'X-Pynth-Audio-Seconds': f"{report['audio_samples'] / defaults.SAMPLE_RATE:.6f}",
+            'X-Pynth-Render-Seconds': f"{report['total_wall']:.6f}",
+            'X-Pynth-Total-Seconds': f"{time.perf_counter() - start:.6f}",
+        })
+
+class QueueFull(Exception):
+    pass
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# minimal HTTP parsing and writing
+async def read_request(reader):
+    line = await reader.readline()
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HTTPError(400, "Bad request line")
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0) or 0)
+    if length > MAX_BODY:
+        raise HTTPError(413, f"MIDI data larger than {MAX_BODY} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+          422: "Unprocessable Entity", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+def status_line(status):
+    return f"HTTP/1.1 {status} {STATUS.get(status, '')}\r\n"
+
+async def send_json(writer, status, payload):
+    body = json.dumps(payload).encode()
+    head = status_line(status) + f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+## chunked transfer encoding, so large files start arriving before they are fully written to the socket
+async def send_stream(writer, data, headers):
+    head = status_line(200) + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+    head += "Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+    writer.write(head.encode('latin-1'))
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+# client
+## HTTP connection over a Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout = None):
+        super().__init__("localhost", timeout = timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def connect(host = DEFAULT_HOST, port = DEFAULT_PORT, socket_path = None, timeout = None):
+    if socket_path:
+        return UnixHTTPConnection(socket_path, timeout = timeout)
+    return http.client.HTTPConnection(host, port, timeout = timeout)
+
+## renders MIDI bytes (or a MIDI file path) on a running server ; returns (FLAC bytes, response headers)
+## raises RuntimeError with the server message when the render fails
+def render_remote(midi_in, params = None, priority = 0, host = DEFAULT_HOST, port = DEFAULT_PORT, socket_path = None, timeout = None):
+    if isinstance(midi_in, (str, os.PathLike)):
+        with open(midi_in, "rb") as f:
+            midi_in = f.read()
+    conn = connect(host, port, socket_path, timeout)
+    try:
+        conn.request("POST", "/render", body = midi_in, headers = {
+            'Content-Type': 'audio/midi',
+            'X-Pynth-Params': json.dumps(params or {}),
+            'X-Pynth-Priority': str(int(priority)),
+        })
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Render failed ({response.status}) : {json.loads(data).get('error')}")
+        return data, dict(response.getheaders())
+    finally:
+        conn.close()
+
+## reads the metrics of a running server
+def fetch_metrics(host = DEFAULT_HOST, port = DEFAULT_PORT, socket_path = None, timeout = None):
+    conn = connect(host, port, socket_path, timeout)
+    try:
+        conn.request("GET", "/metrics")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+# runs a server on its own event loop in a background thread, e.g. for local checks
+## returns (server, stop function) once the server accepts connections
+def start_in_thread(**kwargs):
+    server = RenderServer(**kwargs)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    errors = []
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(server.start())
+        except Exception as e:
+            errors.append(e)
+            ready.set()
+            return
+        ready.set()
+        loop.run_forever()
+    thread = threading.Thread(target = run, name = "pynth-server", daemon = True)
+    thread.start()
+    ready.wait()
+    if errors:
+        raise errors[0]
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return server, stop
+
+# command line entry point
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pynth.server", description = "Local pynth render server")
+    parser.add_argument("--host", default = DEFAULT_HOST, help = "address to listen on (keep it local)")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT, help = "TCP port, 0 picks a free one")
+    parser.add_argument("--socket", help = "listens on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type = int, help = "worker processes (default: CPU count - 1)")
+    parser.add_argument("--concurrency", type = int, help = "jobs rendered at the same time (default: one per worker)")
+    parser.add_argument("--max-queue", type = int, default = 64, help = "waiting jobs before new ones are refused")
+    args = parser.parse_args(argv)
+    server = RenderServer(args.host, args.port, args.socket, args.workers, args.concurrency, args.max_queue)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+# libraries
+import argparse
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import numpy as np
+from . import defaults, midi, automation as auto
+from .cancellation import check
+from .regions import render_window, NoteIndex
+from .voices import limit_polyphony
+from .lazy import lazy_import
+
+# soundfile is only needed to write FLAC files
+sf = lazy_import("soundfile")
+
+# parameter sweeps : one MIDI file rendered under many variants of a patch
+## a patch holds the midi.midi_to_audio parameters ; variants are overrides of the base patch, given as
+## dotted paths, e.g. {'fx.reverb.mix': 0.3, 'filters.lowpass.cutoff': 2000, 'osc.1.volume': 0.5}
+## every intermediate result is computed once and shared by the variants that need it :
+## parse -> per-oscillator tracks (keyed without their volume) -> dry mix -> AM + effects -> filters + FLAC
+## the last two are fanned out per variant, optionally across processes
+PATCH_KEYS = ('wf', 'adsr', 'fx', 'osc', 'am_lfo', 'fm_lfo', 'filters', 'automation', 'voices', 'region')
+MANIFEST = "manifest.json"
+
+# full patch, with the defaults midi_to_audio would use
+## osc stays None until the overrides are applied : the default oscillator follows the variant's own wf
+def make_patch(wf = "sine", adsr = None, fx = None, osc = None, am_lfo = None, fm_lfo = None, filters = None, automation = None, voices = None, region = None):
+    return copy.deepcopy({
+        'wf': wf,
+        'adsr': adsr if adsr is not None else defaults.DEFAULT_ADSR,
+        'fx': fx or {},
+        'osc': osc,
+        'am_lfo': am_lfo,
+        'fm_lfo': fm_lfo,
+        'filters': filters,
+        'automation': automation if automation is not None else defaults.DEFAULT_AUTOMATION,
+        'voices': voices if voices is not None else defaults.DEFAULT_VOICES,
+        'region': list(region) if region is not None else None,
+    })
+
+# oscillators of a patch : the default one, playing wf, when osc is not set
+def patch_oscillators(patch):
+    if patch['osc'] is not None:
+        return patch['osc']
+    return [{'enabled': True, 'waveform': patch['wf'], 'volume': 1.0, 'pitch': 0}]
+
+# sets a dotted path in a patch, creating missing sections ; None removes the key (e.g. 'fx.reverb')
+def set_path(patch, path, value):
+    parts = path.split(".")
+    if parts[0] not in PATCH_KEYS:
+        raise ValueError(f"Unknown parameter : {parts[0]}")
+    if parts[0] == 'osc' and len(parts) > 1 and patch['osc'] is None:
+        patch['osc'] = patch_oscillators(patch)
+    node = patch
+    for i, part in enumerate(parts[:-1]):
+        if isinstance(node, list):
+            node = node[int(part)]
+            continue
+        if node.get(part) is None:
+            node[part] = {}
+        node = node[part]
+    last = parts[-1]
+    if isinstance(node, list):
+        node[int(last)] = value
+    elif value is None and len(parts) > 1:
+        node.pop(last, None)
+    else:
+        node[last] = value
+
+## wf is set first, so oscillator overrides start from the variant's default oscillator
+def apply_overrides(base, overrides):
+    patch = copy.deepcopy(base)
+    for path, value in sorted(overrides.items(), key = lambda item: item[0] != 'wf'):
+        set_path(patch, path, copy.deepcopy(value))
+    return patch
+
+# every combination of the axes (path -> list of values), as a list of overrides
+def grid(axes):
+    paths = list(axes)
+    return [dict(zip(paths, values)) for values in itertools.product(*(axes[p] for p in paths))]
+
+# parses grid axes written as "fx.reverb.mix=0.1,0.3; filters.lowpass.cutoff=2000,4000"
+## values are read as JSON when they can be (numbers, true/false, null), as text otherwise
+def parse_grid(text):
+    axes = {}
+    for item in text.replace("\n", ";").split(";"):
+        if not item.strip():
+            continue
+        path, sep, values = item.partition("=")
+        if not sep or not values.strip():
+            raise ValueError(f"Expected path=value,value,... : {item.strip()}")
+        axes[path.strip()] = [parse_value(v) for v in values.split(",")]
+    return axes
+
+def parse_value(text):
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+# cache key of a stage : its inputs, as canonical JSON
+def stage_key(*parts):
+    return json.dumps(parts, sort_keys = True)
+
+def enabled(section):
+    return section if section is not None and section.get('enabled') else None
+
+## window a variant is rendered on, as midi_to_audio would : (first sample, samples, samples to skip, region samples)
+def variant_window(patch, song_length):
+    if patch['region'] is None:
+        return 0, song_length, 0, None
+    return render_window(patch['region'], song_length, patch['fx'], patch['filters'])
+
+## window covering every variant's window, so they all share the synthesis
+def shared_window(windows):
+    first = min(w[0] for w in windows)
+    return first, max(w[0] + w[1] for w in windows) - first
+
+# stage keys of a variant
+def variant_keys(patch):
+    prep = stage_key(patch['region'], patch['voices'], patch['automation'])
+    tracks = []
+    for o in patch_oscillators(patch):
+        if not o.get('enabled', True):
+            continue
+        timbre = {k: v for k, v in o.items() if k not in ('volume', 'enabled')}
+        tracks.append((stage_key(prep, timbre, patch['adsr'], enabled(patch['fm_lfo'])), o.get('volume', 1.0), timbre))
+    dry = stage_key(prep, [(t[0], t[1]) for t in tracks])
+    wet = stage_key(dry, enabled(patch['am_lfo']), patch['fx'])
+    return {'prep': prep, 'tracks': tracks, 'dry': dry, 'wet': wet}
+
+# AM, effects, then the filters and FLAC file of every variant sharing them
+## runs in the calling process or in a worker : dry is not modified
+## variants : list of (index, filters, automation, path)
+def render_downstream(dry, tempo, curves, offset, trim, am_lfo, fx, variants, cancel = None):
+    stages = {}
+    start = time.perf_counter()
+    audio = midi.apply_am_lfo(dry.copy(), tempo, am_lfo, offset, cancel)
+    stages['am'] = time.perf_counter() - start
+    start = time.perf_counter()
+    audio = midi.normalize(midi.apply_effects(audio, fx, cancel = cancel, curves = curves, offset = offset))
+    stages['effects'] = time.perf_counter() - start
+    results = []
+    for index, filters, automation, path in variants:
+        check(cancel)
+        start = time.perf_counter()
+        out = midi.apply_filters(audio, filters, curves, automation, cancel)
+        if trim is not None:
+            out = out[trim[0]:trim[0] + trim[1]]
+        filtered = time.perf_counter()
+        sf.write(path, out, defaults.SAMPLE_RATE, format = "FLAC")
+        results.append({'index': index, 'stages': {'filters': filtered - start, 'flac': time.perf_counter() - filtered},
+                        'audio_seconds': len(out) / defaults.SAMPLE_RATE})
+    return {'stages': stages, 'variants': results}
+
+# renders every variant to out_dir and writes the manifest ; returns the manifest
+## base : base patch (see make_patch), overrides : list of override dicts (see grid), one file per entry
+## workers : processes used for the AM / effects / filters stages (1 : all in this process)
+## progress : optional callable receiving the fraction of variants written
+def run_sweep(midi_in, out_dir, base = None, overrides = None, workers = 1, name = None, cancel = None, progress = None):
+    sweep_start = time.perf_counter()
+    base = make_patch(**(base or {}))
+    overrides = overrides if overrides else [{}]
+    patches = [apply_overrides(base, o) for o in overrides]
+    keys = [variant_keys(p) for p in patches]
+    os.makedirs(out_dir, exist_ok = True)
+    if name is None:
+        name = os.path.splitext(os.path.basename(midi_in))[0] if isinstance(midi_in, (str, os.PathLike)) else "sweep"
+    paths = [os.path.join(out_dir, f"{name}_{i:03d}.flac") for i in range(len(patches))]
+    entries = [{'index': i, 'file': os.path.basename(paths[i]), 'overrides': overrides[i], 'stages': {}, 'reused': []}
+               for i in range(len(patches))]
+    computed = {'parse': 1, 'prepare': 0, 'tracks': 0, 'dry': 0, 'effects': 0, 'filters': len(patches)}
+
+    # parse, once
+    start = time.perf_counter()
+    controls = []
+    notes, tempo = midi.parse_midi(midi_in, controls)
+    if not notes:
+        raise ValueError("No notes found")
+    song_length = midi.audio_length(notes)
+    windows = [variant_window(p, song_length) for p in patches]
+    entries[0]['stages']['parse'] = time.perf_counter() - start
+    for e in entries[1:]:
+        e['reused'].append('parse')
+
+    ## reference counts, so intermediate results are dropped as soon as no variant needs them
+    track_refs = {}
+    for k in {k['dry']: k for k in keys}.values():
+        for t in k['tracks']:
+            track_refs[t[0]] = track_refs.get(t[0], 0) + 1
+    prepared, tracks, done = {}, {}, [0]
+    def finished(result):
+        for e in result['variants']:
+            entries[e['index']]['stages'].update(e['stages'])
+            entries[e['index']]['audio_seconds'] = e['audio_seconds']
+            done[0] += 1
+        if progress is not None:
+            progress(done[0] / len(patches))
+
+    ## variants grouped by dry mix, then by AM + effects
+    order = sorted(range(len(patches)), key = lambda i: (keys[i]['dry'], keys[i]['wet'], windows[i], i))
+    pool = ProcessPoolExecutor(max_workers = workers) if workers > 1 else None
+    futures = []
+    try:
+        for dry_key, dry_group in itertools.groupby(order, key = lambda i: keys[i]['dry']):
+            dry_group = list(dry_group)
+            first = dry_group[0]
+            patch, k = patches[first], keys[first]
+            check(cancel)
+            # note selection, voices and control curves
+            if k['prep'] not in prepared:
+                start = time.perf_counter()
+                offset, length = shared_window([w for w, pk in zip(windows, keys) if pk['prep'] == k['prep']])
+                selected, note_voices, note_cuts = notes, None, None
+                if patch['region'] is not None:
+                    selected, note_voices, note_cuts = limit_polyphony(notes, patch['voices']['max_polyphony'], patch['voices']['steal'])
+                    idx = NoteIndex(selected).query(offset / defaults.SAMPLE_RATE, (offset + length) / defaults.SAMPLE_RATE)
+                    selected = [selected[i] for i in idx]
+                    note_voices = [note_voices[i] for i in idx]
+                    note_cuts = [note_cuts[i] for i in idx]
+                curves = {}
+                if patch['automation']['enabled'] and controls:
+                    curves = auto.build_control_curves(controls, length, patch['automation'], offset)
+                prepared[k['prep']] = (selected, note_voices, note_cuts, offset, length, curves)
+                entries[first]['stages']['prepare'] = time.perf_counter() - start
+                computed['prepare'] += 1
+            else:
+                entries[first]['reused'].append('prepare')
+            selected, note_voices, note_cuts, offset, length, curves = prepared[k['prep']]
+            # one track per oscillator timbre, mixed by volume
+            start = time.perf_counter()
+            dry = np.zeros(length, dtype = np.float32)
+            reused = False
+            for track_key, volume, timbre in k['tracks']:
+                if track_key not in tracks:
+                    osc = [dict(timbre, enabled = True, volume = 1.0)]
+                    tracks[track_key] = midi.render_notes(selected, tempo, adsr = patch['adsr'], osc = osc, fm_lfo = patch['fm_lfo'], cancel = cancel,
+                                                          curves = curves, voices = patch['voices'], note_voices = note_voices, note_cuts = note_cuts, offset = offset, length = length)
+                    computed['tracks'] += 1
+                else:
+                    reused = True
+                dry += tracks[track_key] * volume
+                track_refs[track_key] -= 1
+                if track_refs[track_key] == 0:
+                    del tracks[track_key]
+            computed['dry'] += 1
+            entries[first]['stages']['synth'] = time.perf_counter() - start
+            if reused:
+                entries[first]['reused'].append('tracks')
+            for i in dry_group[1:]:
+                entries[i]['reused'].append('synth')
+            # AM and effects on each variant's own window, then the filters of each variant
+            for wet_key, wet_group in itertools.groupby(dry_group, key = lambda i: (keys[i]['wet'], windows[i])):
+                wet_group = list(wet_group)
+                for i in wet_group[1:]:
+                    entries[i]['reused'].append('effects')
+                computed['effects'] += 1
+                variants = [(i, patches[i]['filters'], patches[i]['automation'], paths[i]) for i in wet_group]
+                wet_patch = patches[wet_group[0]]
+                first_sample, window_length, skip, region_length = windows[wet_group[0]]
+                window_curves = curves
+                if (first_sample, window_length) != (offset, length):
+                    window_curves = {}
+                    if patch['automation']['enabled'] and controls:
+                        window_curves = auto.build_control_curves(controls, window_length, patch['automation'], first_sample)
+                window = dry[first_sample - offset:first_sample - offset + window_length]
+                gain = auto.gain_curve(window_curves)
+                if gain is not None:
+                    window = window * gain
+                window = midi.normalize(window)
+                trim = (skip, region_length) if region_length is not None else None
+                args = (window, tempo, window_curves, first_sample, trim, enabled(wet_patch['am_lfo']), wet_patch['fx'], variants)
+                if pool is None:
+                    result = render_downstream(*args, cancel = cancel)
+                    entries[wet_group[0]]['stages'].update(result['stages'])
+                    finished(result)
+                else:
+                    futures.append((wet_group[0], pool.submit(render_downstream, *args)))
+        for first, future in futures:
+            while True:
+                check(cancel)
+                try:
+                    result = future.result(timeout = 0.1)
+                    break
+                except TimeoutError:
+                    continue
+            entries[first]['stages'].update(result['stages'])
+            finished(result)
+    finally:
+        if pool is not None:
+            ## jobs not started yet are dropped (cancel_futures needs python 3.9)
+            for _, future in futures:
+                future.cancel()
+            pool.shutdown(wait = True)
+
+    for e in entries:
+        e['seconds'] = sum(e['stages'].values())
+    manifest = {
+        'midi': midi_in if isinstance(midi_in, str) else None,
+        'base': base,
+        'workers': workers,
+        'variants': entries,
+        'computed': computed,
+        'naive': {'renders': len(patches), 'tracks': sum(len(k['tracks']) for k in keys)},
+        'total_seconds': time.perf_counter() - sweep_start,
+    }
+    with open(os.path.join(out_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent = 2)
+    return manifest
+
+# command line entry point
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pynth.sweep", description = "Renders a MIDI file under many variants of a patch")
+    parser.add_argument("midi", type = midi.check_midi_input_path, help = "MIDI file to render")
+    parser.add_argument("out", help = "output folder (FLAC files and manifest.json)")
+    parser.add_argument("--base", help = "JSON file with the base patch (midi_to_audio parameters)")
+    parser.add_argument("--grid", action = "append", default = [], help = "axis as path=value,value (repeatable), e.g. fx.reverb.mix=0.1,0.3")
+    parser.add_argument("--overrides", help = "JSON file with a list of overrides, one variant each")
+    parser.add_argument("--workers", type = int, default = 1, help = "processes used for the effects and filters")
+    args = parser.parse_args(argv)
+    base = {}
+    if args.base:
+        with open(args.base) as f:
+            base = json.load(f)
+    overrides = []
+    if args.overrides:
+        with open(args.overrides) as f:
+            overrides = json.load(f)
+    if args.grid:
+        axes = parse_grid(";".join(args.grid))
+        overrides = [dict(o, **g) for o in (overrides or [{}]) for g in grid(axes)]
+    manifest = run_sweep(args.midi, args.out, base, overrides, workers = args.workers)
+    computed, naive = manifest['computed'], manifest['naive']
+    print(f"{len(manifest['variants'])} variants rendered to {args.out} in {manifest['total_seconds']:.2f} s "
+          f"({computed['tracks']} oscillator tracks instead of {naive['tracks']})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# libraries
+import time
+import tracemalloc
+from . import defaults
+
+# measurements for one stage of the render
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.samples = 0
+        self.peak_bytes = 0
+        self.finished = False
+
+    # seconds of audio processed per second of wall time
+    @property
+    def realtime_factor(self):
+        if self.wall <= 0 or not self.samples:
+            return None
+        return self.samples / defaults.SAMPLE_RATE / self.wall
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'samples': self.samples,
+            'peak_bytes': self.peak_bytes,
+            'realtime_factor': self.realtime_factor,
+        }
+
+# structured report of a whole render, returned with the audio when profiling is on
+class RenderReport:
+    def __init__(self):
+        self.stages = []
+        self.audio_samples = 0
+
+    @property
+    def total_wall(self):
+        return sum(s.wall for s in self.stages)
+
+    @property
+    def total_cpu(self):
+        return sum(s.cpu for s in self.stages)
+
+    @property
+    def peak_bytes(self):
+        return max((s.peak_bytes for s in self.stages), default = 0)
+
+    ## while rendering, the length of the audio is taken from the stages already finished
+    @property
+    def realtime_factor(self):
+        samples = self.audio_samples or max((s.samples for s in self.stages), default = 0)
+        if self.total_wall <= 0 or not samples:
+            return None
+        return samples / defaults.SAMPLE_RATE / self.total_wall
+
+    # wall time of the stages, merged by name
+    def breakdown(self):
+        times = {}
+        for s in self.stages:
+            times[s.name] = times.get(s.name, 0.0) + s.wall
+        return times
+
+    def to_dict(self):
+        return {
+            'stages': [s.to_dict() for s in self.stages],
+            'audio_samples': self.audio_samples,
+            'total_wall': self.total_wall,
+            'total_cpu': self.total_cpu,
+            'peak_bytes': self.peak_bytes,
+            'realtime_factor': self.realtime_factor,
+        }
+
+    # one line summary, as shown in the GUI status bar
+    def summary(self):
+        parts = [format_stage(name, wall) for name, wall in self.breakdown().items()]
+        rtf = self.realtime_factor
+        if rtf is not None:
+            parts.append(f"x{rtf:.1f} realtime")
+        return " | ".join(parts)
+
+# formats a stage duration
+def format_stage(name, wall):
+    if wall >= 1.0:
+        return f"{name} {wall:.2f} s"
+    return f"{name} {wall * 1000:.0f} ms"
+
+# context manager timing one stage
+class _Stage:
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.stats = StageStats(name)
+
+    def __enter__(self):
+        tel = self.telemetry
+        if tel.observer is not None:
+            tel.observer(self.stats)
+        if tel.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._stop_tracing = True
+            else:
+                self._stop_tracing = False
+            self._base = tracemalloc.get_traced_memory()[0]
+            ## reset_peak only exists from python 3.9
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, exc_type, exc, tb):
+        stats = self.stats
+        stats.wall = time.perf_counter() - self._wall
+        stats.cpu = time.process_time() - self._cpu
+        tel = self.telemetry
+        if tel.track_memory:
+            stats.peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - self._base)
+            if self._stop_tracing:
+                tracemalloc.stop()
+        stats.finished = True
+        tel.report.stages.append(stats)
+        if tel.observer is not None:
+            tel.observer(stats)
+        return False
+
+# collects the stage measurements of a render
+## observer : optional callable, called with the StageStats when a stage starts and when it finishes
+## track_memory : records the peak allocation of each stage (tracemalloc makes python loops much slower)
+class Telemetry:
+    enabled = True
+
+    def __init__(self, observer = None, track_memory = True):
+        self.observer = observer
+        self.track_memory = track_memory
+        self.report = RenderReport()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+# no-op context manager, shared by every stage when telemetry is off
+class _NullStage:
+    def __init__(self):
+        self.stats = StageStats("")
+
+    def __enter__(self):
+        return self.stats
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+# telemetry used when profiling is off : stages cost a method call and nothing is recorded
+class NullTelemetry:
+    enabled = False
+    observer = None
+    report = None
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+NULL_TELEMETRY = NullTelemetry()
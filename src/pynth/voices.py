@@ -0,0 +1,106 @@
+# libraries
+import numpy as np
+from . import defaults
+
+STEAL_POLICIES = defaults.STEAL_POLICIES
+
+# allocates a fixed number of voices to notes, stealing one when they are all busy
+## a voice is busy until busy_until : the note end in the batch engine, +inf while held in the live engine
+## stealing policies :
+##  oldest : the voice started first
+##  quietest : the voice with the lowest velocity (oldest first among equals)
+##  same-note : the voice already playing the same note, else the oldest
+## released voices (still ringing, no longer held) are always stolen before held ones
+class VoiceManager:
+    def __init__(self, max_polyphony = 64, policy = 'oldest'):
+        if policy not in STEAL_POLICIES:
+            raise ValueError(f"Unknown voice stealing policy : {policy}")
+        if max_polyphony < 1:
+            raise ValueError("Polyphony must be at least 1")
+        self.max_polyphony = max_polyphony
+        self.policy = policy
+        ## per-voice state, preallocated
+        self.note = np.full(max_polyphony, -1, dtype = np.int16)
+        self.velocity = np.zeros(max_polyphony, dtype = np.float32)
+        self.start = np.zeros(max_polyphony)
+        self.busy_until = np.full(max_polyphony, -np.inf)
+        self.owner = np.full(max_polyphony, -1, dtype = np.int64)
+        self.stolen = 0
+
+    # voices free at a given time
+    def free_voices(self, time):
+        return np.flatnonzero(self.busy_until <= time)
+
+    # voices still sounding at a given time
+    def active_voices(self, time):
+        return np.flatnonzero(self.busy_until > time)
+
+    def pick_victim(self, note):
+        released = np.flatnonzero(np.isfinite(self.busy_until))
+        candidates = released if len(released) else np.arange(self.max_polyphony)
+        if self.policy == 'same-note':
+            same = candidates[self.note[candidates] == note]
+            if len(same):
+                candidates = same
+        elif self.policy == 'quietest':
+            quietest = self.velocity[candidates].min()
+            candidates = candidates[self.velocity[candidates] == quietest]
+        return int(candidates[np.argmin(self.start[candidates])])
+
+    # assigns a voice to a new note, returning (voice, owner of the stolen voice or None)
+    ## until : end of the note when it is known (batch), else the voice is held until note_off
+    def note_on(self, note, velocity, time, until = np.inf, owner = -1):
+        free = self.free_voices(time)
+        stolen = None
+        if len(free):
+            voice = int(free[0])
+        else:
+            voice = self.pick_victim(note)
+            stolen = int(self.owner[voice])
+            self.stolen += 1
+        self.note[voice] = note
+        self.velocity[voice] = velocity
+        self.start[voice] = time
+        self.busy_until[voice] = until
+        self.owner[voice] = owner
+        return voice, stolen
+
+    # releases the held voices playing a note, which stay busy for the release time
+    def note_off(self, note, time, release = 0.0):
+        voices = np.flatnonzero((self.note == note) & (self.busy_until == np.inf))
+        self.busy_until[voices] = time + release
+        return voices
+
+    # frees a voice right away
+    def kill(self, voice):
+        self.busy_until[voice] = -np.inf
+        self.owner[voice] = -1
+
+# preallocated, fixed-size render buffers, one per voice, reused from note to note
+class VoicePool:
+    def __init__(self, max_polyphony = 64, block_size = None):
+        self.block_size = block_size or defaults.VOICE_BLOCK_SIZE
+        self.buffers = np.zeros((max_polyphony, self.block_size), dtype = np.float32)
+
+    # cleared buffer of a voice, for a block of n samples
+    def buffer(self, voice, n):
+        buf = self.buffers[voice, :n]
+        buf.fill(0.0)
+        return buf
+
+# applies the polyphony limit to parsed notes : stolen notes are cut when their voice is taken
+## returns (notes, voices, cuts) in the original order ; cuts holds the time a note is stolen, or None
+## notes keep their own end, so their envelope is the one of the whole note ; notes cut before they start are dropped
+def limit_polyphony(rendered_notes, max_polyphony = 64, policy = 'oldest'):
+    manager = VoiceManager(max_polyphony, policy)
+    cuts = [None] * len(rendered_notes)
+    voices = [0] * len(rendered_notes)
+    order = sorted(range(len(rendered_notes)), key = lambda i: rendered_notes[i][0])
+    for i in order:
+        start, end, note, velocity = rendered_notes[i]
+        voice, stolen = manager.note_on(note, velocity, start, until = end, owner = i)
+        voices[i] = voice
+        if stolen is not None and start < rendered_notes[stolen][1]:
+            cuts[stolen] = start if cuts[stolen] is None else min(cuts[stolen], start)
+    kept = [i for i in range(len(rendered_notes)) if (rendered_notes[i][1] if cuts[i] is None else cuts[i]) > rendered_notes[i][0]]
+    return [rendered_notes[i] for i in kept], [voices[i] for i in kept], [cuts[i] for i in kept]
@@ -1,31 +1,46 @@
 import numpy as np
-from scipy import signal
+
+# numpy versions of scipy.signal.sawtooth / square (same formulas), so rendering doesn't import scipy
+## rising ramp (width = 1) or triangle (width = 0.5)
+def sawtooth(phase, width = 1.0):
+    tmod = np.mod(phase, 2 * np.pi)
+    if width == 1.0:
+        return tmod / (np.pi * width) - 1
+    return np.where(tmod < width * 2 * np.pi, tmod / (np.pi * width) - 1, (np.pi * (width + 1) - tmod) / (np.pi * (1 - width)))
+
+def square(phase):
+    tmod = np.mod(phase, 2 * np.pi)
+    return np.where(tmod < np.pi, 1.0, -1.0)
 
 ## generates a waveform
 def generate_waveform(freq, t, waveform="sine"):
     if waveform == "saw" :
-        return signal.sawtooth(2 * np.pi * freq * t)
+        return sawtooth(2 * np.pi * freq * t)
     elif waveform == "sine" : 
         return np.sin(2 * np.pi * freq * t)
     elif waveform == "square" : 
-        return signal.square(2 * np.pi * freq * t)
+        return square(2 * np.pi * freq * t)
     elif waveform == "triangle" : 
-        return signal.sawtooth(2 * np.pi * freq * t, width = 0.5)
+        return sawtooth(2 * np.pi * freq * t, width = 0.5)
     else : 
         raise ValueError(f"Unknown wave type : {waveform}")
 
-## generates a waveform with frequency modulation
-def generate_waveform_fm(freq, t, modulator_signal, fm_depth, waveform="sine"):
-    dt = t[1] - t[0] if len(t) > 1 else 1.0 / 44100
-    phase_deviation = fm_depth * np.cumsum(modulator_signal) * dt
-    phase = 2 * np.pi * freq * t + 2 * np.pi * phase_deviation
+## generates a waveform from its phase (in radians)
+def generate_waveform_phase(phase, waveform="sine"):
     if waveform == "sine" :
         return np.sin(phase)
     elif waveform == "saw" :
-        return signal.sawtooth(phase)
+        return sawtooth(phase)
     elif waveform == "square" :
-        return signal.square(phase)
+        return square(phase)
     elif waveform == "triangle" :
-        return signal.sawtooth(phase, width = 0.5)
+        return sawtooth(phase, width = 0.5)
     else :
-        raise ValueError(f"Unknown wave type : {waveform}")
\ No newline at end of file
+        raise ValueError(f"Unknown wave type : {waveform}")
+
+## generates a waveform with frequency modulation
+def generate_waveform_fm(freq, t, modulator_signal, fm_depth, waveform="sine"):
+    dt = t[1] - t[0] if len(t) > 1 else 1.0 / 44100
+    phase_deviation = fm_depth * np.cumsum(modulator_signal) * dt
+    phase = 2 * np.pi * freq * t + 2 * np.pi * phase_deviation
+    return generate_waveform_phase(phase, waveform)
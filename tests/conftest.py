@@ -0,0 +1,10 @@
+# libraries
+from pathlib import Path
+import pytest
+
+# MIDI file shipped with the repository, used as the test song
+TEST_MIDI = Path(__file__).resolve().parent.parent / "test.mid"
+
+@pytest.fixture(scope = 'session')
+def song():
+    return str(TEST_MIDI)
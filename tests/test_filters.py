@@ -0,0 +1,69 @@
+# libraries
+import numpy as np
+import pytest
+from scipy import signal
+from pynth import defaults
+from pynth import filter as flt
+from pynth.cancellation import CancelToken, RenderCancelled
+from pynth import effects
+from pynth.midi import apply_am_lfo, apply_filters
+
+FILTERS = {
+    'lowpass': dict(defaults.DEFAULT_FILTERS['lowpass'], enabled = True),
+    'highpass': dict(defaults.DEFAULT_FILTERS['highpass'], enabled = True),
+}
+
+def noise(seconds, seed = 0):
+    return np.random.default_rng(seed).uniform(-1.0, 1.0, int(seconds * defaults.SAMPLE_RATE)).astype(np.float32)
+
+# token cancelled at its n-th check
+class CancelAfter(CancelToken):
+    def __init__(self, n):
+        super().__init__()
+        self.checks = 0
+        self.n = n
+
+    def check(self):
+        self.checks += 1
+        if self.checks >= self.n:
+            self.cancel()
+        super().check()
+
+@pytest.mark.parametrize('btype', ['low', 'high'])
+@pytest.mark.parametrize('length', [16, 1000, 3 * flt.FILTER_BLOCK_SIZE + 17])
+def test_blockwise_filtfilt_matches_scipy(btype, length):
+    b, a = flt.butter_ba(1000.0, 4, btype)
+    audio = noise(1.0)[:length]
+    np.testing.assert_array_equal(flt.filtfilt(b, a, audio), signal.filtfilt(b, a, audio))
+
+def test_filters_check_the_token_every_block():
+    audio = noise(10.0)
+    token = CancelAfter(10 ** 6)
+    apply_filters(audio, FILTERS, cancel = token)
+    ## forward and backward passes of both filters, on the padded audio
+    assert token.checks >= 4 * len(audio) // flt.FILTER_BLOCK_SIZE
+
+def test_filters_can_be_cancelled():
+    token = CancelAfter(3)
+    with pytest.raises(RenderCancelled):
+        apply_filters(noise(10.0), FILTERS, cancel = token)
+    assert token.checks == 3
+
+def test_modulated_lowpass_can_be_cancelled():
+    audio = noise(10.0)
+    cutoff = np.geomspace(200.0, 8000.0, len(audio))
+    token = CancelAfter(3)
+    with pytest.raises(RenderCancelled):
+        flt.apply_lowpass_modulated(audio, cutoff, cancel = token)
+    assert token.checks == 3
+
+## the chorus LFO and the AM modulator are built block by block, with a check before each block
+def test_chorus_and_am_check_the_token_every_block():
+    audio = noise(10.0)
+    blocks = -(-len(audio) // defaults.EFFECT_BLOCK_SIZE)
+    token = CancelAfter(10 ** 6)
+    effects.apply_chorus(audio, cancel = token)
+    assert token.checks == blocks
+    token = CancelAfter(10 ** 6)
+    apply_am_lfo(audio.copy(), defaults.DEFAULT_TEMPO, dict(defaults.DEFAULT_AM_LFO, enabled = True), cancel = token)
+    assert token.checks == blocks
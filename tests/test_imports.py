@@ -0,0 +1,26 @@
+# libraries
+import pytest
+from pynth.bench import import_time
+
+# import-time budgets, in seconds (cumulative time reported by python -X importtime, best of RUNS)
+IMPORT_BUDGETS = {
+    'pynth.gui': 0.5,
+    'pynth.midi': 0.5,
+}
+RUNS = 3
+# modules that must not be loaded by an import : the GUI shows up before the render stack,
+# and a headless render never loads the GUI or the audio device
+FORBIDDEN_IMPORTS = {
+    'pynth.gui': ['numpy', 'scipy', 'mido', 'soundfile', 'sounddevice', 'numba'],
+    'pynth.midi': ['customtkinter', 'tkinter', 'sounddevice', 'soundfile', 'scipy', 'numba'],
+}
+
+@pytest.mark.parametrize('module', sorted(IMPORT_BUDGETS))
+def test_import_budget(module):
+    seconds = min(import_time(module)[0] for _ in range(RUNS))
+    assert seconds <= IMPORT_BUDGETS[module], f"{module} takes {seconds * 1000:.1f} ms to import"
+
+@pytest.mark.parametrize('module', sorted(FORBIDDEN_IMPORTS))
+def test_forbidden_imports(module):
+    loaded = sorted(m for m in FORBIDDEN_IMPORTS[module] if m in import_time(module)[1])
+    assert not loaded, f"{module} loads {', '.join(loaded)}"
@@ -0,0 +1,63 @@
+# libraries
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from pynth import kernels
+from pynth.bench import kernel_cases
+
+needs_numba = pytest.mark.skipif(not kernels.numba_available(), reason = "numba is not installed")
+
+SECONDS = 2.0
+TOLERANCE = 1e-9
+
+def run(name, backend, make, out):
+    args = make()
+    result = kernels.get_kernel(name, backend)(*args)
+    if out is not None:
+        return args[out]
+    return result[0] if isinstance(result, tuple) else result
+
+# backend setting for one test
+@pytest.fixture
+def backend():
+    saved = kernels._state['backend']
+    yield kernels.set_backend
+    kernels.set_backend(saved)
+
+def test_every_kernel_has_a_numba_version():
+    assert all('numba' in impl for impl in kernels.KERNELS.values())
+
+@needs_numba
+@pytest.mark.parametrize('case', sorted(kernel_cases(0.1)))
+def test_numba_matches_numpy(case):
+    name, make, out = kernel_cases(SECONDS)[case]
+    reference = run(name, 'numpy', make, out)
+    value = run(name, 'numba', make, out)
+    assert value.shape == reference.shape
+    assert np.max(np.abs(value - reference)) <= TOLERANCE
+
+def test_numpy_backend(backend):
+    backend('numpy')
+    assert all(kernels.get_kernel(name) is impl['numpy'] for name, impl in kernels.KERNELS.items())
+
+@needs_numba
+def test_auto_backend_only_uses_numba_where_it_wins(backend):
+    backend('auto')
+    for name, impl in kernels.KERNELS.items():
+        assert (kernels.get_kernel(name) is not impl['numpy']) == (name in kernels.AUTO_NUMBA)
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        kernels.set_backend('fortran')
+
+# a render with the default settings never imports numba
+def test_default_render_does_not_load_numba(song):
+    env = {k: v for k, v in os.environ.items() if k != 'PYNTH_KERNELS'}
+    env['PYTHONPATH'] = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    code = (f"import sys ; from pynth import defaults, midi ; midi.midi_to_audio({song!r}, fx = defaults.DEFAULT_EFFECTS, region = (0, 2)) ; "
+            "print('numba' in sys.modules)")
+    out = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, env = env)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.split()[-1] == "False"
@@ -0,0 +1,120 @@
+# libraries
+from types import SimpleNamespace
+import random
+import mido
+import numpy as np
+import pytest
+from pynth import defaults, live
+
+ADSR = dict(attack = 0.005, decay = 0.05, sustain = 0.6, release = 0.1)
+BLOCK_SIZES = (64, 256, 1000)
+
+def make_engine(block_size = live.DEFAULT_BLOCK_SIZE, max_polyphony = 4):
+    return live.LiveEngine(adsr = ADSR, voices = dict(defaults.DEFAULT_VOICES, max_polyphony = max_polyphony), block_size = block_size)
+
+## scripted input : notes, pitch bend and volume at random times, as (seconds, message)
+def script(seed = 0, notes = 40):
+    rng = random.Random(seed)
+    events = [(0.1234, mido.Message('control_change', control = 7, value = 90))]
+    for i in range(notes):
+        t = 0.2 + i * 0.05 + rng.random() * 0.01
+        note = rng.randint(48, 84)
+        events.append((t, mido.Message('note_on', note = note, velocity = rng.randint(40, 127))))
+        events.append((t + 0.03 + rng.random() * 0.2, mido.Message('note_off', note = note)))
+        if i % 7 == 0:
+            events.append((t + 0.01, mido.Message('pitchwheel', pitch = rng.randint(-8192, 8191))))
+    return sorted(events, key = lambda e: e[0])
+
+# renders blocks until the engine has passed a sample, returning [(sample, message)] for the applied events
+def render_until(engine, end):
+    applied = []
+    while engine.clock < end:
+        start = engine.clock
+        applied += [(start + offset, msg) for offset, msg in engine.render()[1]]
+    return applied
+
+@pytest.mark.parametrize('block_size', BLOCK_SIZES)
+def test_events_are_applied_on_their_sample(block_size):
+    engine = make_engine(block_size)
+    rng = np.random.default_rng(1)
+    samples = sorted(int(s) for s in rng.integers(0, 5 * defaults.SAMPLE_RATE // 10, 30))
+    messages = [mido.Message('note_on', note = 60 + i % 12, velocity = 100) for i in range(len(samples))]
+    for sample, msg in zip(samples, messages):
+        engine.schedule(msg, sample)
+    applied = render_until(engine, samples[-1] + 1)
+    assert applied == list(zip(samples, messages))
+    assert engine.late == 0
+
+@pytest.mark.parametrize('block_size', BLOCK_SIZES)
+def test_note_onset(block_size):
+    engine = make_engine(block_size)
+    engine.schedule(mido.Message('note_on', note = 69, velocity = 127), 1234)
+    audio = np.concatenate([engine.render()[0] for _ in range(-(-4096 // block_size))])
+    ## the envelope starts from 0 on the note on sample
+    assert np.flatnonzero(audio)[0] == 1235
+
+def test_output_does_not_depend_on_the_block_size():
+    events = script()
+    outputs = [live.replay(events, make_engine(block_size), delay = 512)[0] for block_size in BLOCK_SIZES]
+    n = min(len(a) for a in outputs)
+    assert np.any(outputs[0][:n])
+    for audio in outputs[1:]:
+        np.testing.assert_allclose(audio[:n], outputs[0][:n], atol = 1e-6)
+
+def test_replay_onset():
+    events = script()
+    audio, _ = live.replay(events, make_engine(256), delay = 512)
+    first = next(t for t, msg in events if msg.type == 'note_on')
+    assert np.flatnonzero(audio)[0] == int(round(first * defaults.SAMPLE_RATE)) + 512 + 1
+
+def test_late_events_play_on_the_next_sample():
+    engine = make_engine(256)
+    engine.render()
+    msg = mido.Message('note_on', note = 60, velocity = 100)
+    engine.schedule(msg, 10)
+    assert engine.late == 1
+    assert engine.render()[1] == [(0, msg)]
+
+# the audio callback of a session, driven with a fake clock : events that arrived during the previous block
+## are played one block later, at the sample matching their arrival, whatever the arrival time
+def test_session_schedules_from_arrival_times(monkeypatch):
+    frames = 256
+    block = frames / defaults.SAMPLE_RATE
+    dac_delay = 0.004
+    session = live.LiveSession(make_engine(frames))
+    clock = {'now': 10.0}
+    monkeypatch.setattr(live.time, 'perf_counter', lambda: clock['now'])
+    status = SimpleNamespace(output_underflow = False)
+    outdata = np.zeros((frames, 1), dtype = np.float32)
+    ## arrivals spread over the last block, in samples before the callback
+    before = [250, 180, 97, 3]
+    for ago in before:
+        session.inbox.put((clock['now'] - ago / defaults.SAMPLE_RATE, mido.Message('note_on', note = 60, velocity = 100)))
+    time_info = SimpleNamespace(currentTime = 0.0, outputBufferDacTime = dac_delay)
+    start = session.engine.clock
+    applied = []
+    monkeypatch.setattr(session.engine, 'apply', lambda msg: applied.append(session.engine.clock + session.engine.position))
+    session.callback(outdata, frames, time_info, status)
+    assert applied == [start + frames - ago for ago in before]
+    s = session.stats.summary()
+    assert s['count'] == len(before)
+    assert s['mean'] == pytest.approx(block + dac_delay, abs = 1 / defaults.SAMPLE_RATE)
+    assert s['jitter'] < 1 / defaults.SAMPLE_RATE
+
+# a stolen voice fades out over STEAL_FADE, as in the batch render, while the new note starts on its sample
+def test_stolen_voice_fades_out():
+    steal = 4000
+    fade = int(defaults.STEAL_FADE * defaults.SAMPLE_RATE)
+    def render(notes):
+        engine = make_engine(max_polyphony = 1)
+        for note, sample in notes:
+            engine.schedule(mido.Message('note_on', note = note, velocity = 100), sample)
+        return np.concatenate([engine.render()[0] for _ in range(40)])
+    stolen = render([(60, 0), (67, steal)])
+    alone = render([(67, steal)])
+    np.testing.assert_array_equal(stolen[:steal], render([(60, 0)])[:steal])
+    ## the taken note still sounds during the fade, then only the new note is left
+    assert np.any(stolen[steal + 2:steal + fade] != alone[steal + 2:steal + fade])
+    np.testing.assert_allclose(stolen[steal + fade + 2:], alone[steal + fade + 2:], atol = 1e-6)
+    ## no jump on the steal : the signal moves no more than the held note did before it
+    assert np.max(np.abs(np.diff(stolen[steal - 8:steal + 8]))) <= 1.5 * np.max(np.abs(np.diff(stolen[steal - 2000:steal - 8])))
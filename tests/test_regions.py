@@ -0,0 +1,34 @@
+# libraries
+import numpy as np
+import pytest
+from pynth import defaults
+from pynth.midi import midi_to_audio
+
+# a region render is normalized on the region, so it is compared to the full render after a gain fit
+REGION = (6.0, 9.0)
+TOLERANCE = 1e-3
+
+EFFECTS = {
+    'dry': {},
+    'chorus': {'chorus': defaults.DEFAULT_EFFECTS['chorus']},
+    'delay': {'delay': defaults.DEFAULT_EFFECTS['delay']},
+    'reverb': {'reverb': defaults.DEFAULT_EFFECTS['reverb']},
+    'all': dict(defaults.DEFAULT_EFFECTS),
+}
+
+## largest difference between the region and the same slice of the full render, relative to the slice peak
+def region_error(full, part):
+    start = int(REGION[0] * defaults.SAMPLE_RATE)
+    expected = full[start:start + len(part)].astype(np.float64)
+    part = part.astype(np.float64)
+    gain = np.dot(part, expected) / np.dot(part, part)
+    return np.max(np.abs(part * gain - expected)) / np.max(np.abs(expected))
+
+@pytest.mark.parametrize('name', sorted(EFFECTS))
+def test_region_matches_full_render(song, name):
+    fx = EFFECTS[name]
+    automation = dict(defaults.DEFAULT_AUTOMATION, enabled = False)
+    full = midi_to_audio(song, fx = fx, filters = {}, automation = automation)[0]
+    part = midi_to_audio(song, fx = fx, filters = {}, automation = automation, region = REGION)[0]
+    assert len(part) == int(REGION[1] * defaults.SAMPLE_RATE) - int(REGION[0] * defaults.SAMPLE_RATE)
+    assert region_error(full, part) < TOLERANCE
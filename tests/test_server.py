@@ -0,0 +1,178 @@
+# libraries
+import copy
+import io
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import numpy as np
+import pytest
+import soundfile as sf
+from pynth import defaults, server
+from pynth.midi import midi_to_audio
+
+PARAMS = {
+    'fx': {'chorus': defaults.DEFAULT_EFFECTS['chorus'], 'delay': defaults.DEFAULT_EFFECTS['delay'], 'reverb': defaults.DEFAULT_EFFECTS['reverb']},
+    'automation': dict(defaults.DEFAULT_AUTOMATION, enabled = False),
+    'region': [4.0, 8.0],
+}
+
+# one server for the module : a Unix socket, two workers and one job at a time, so queued jobs wait
+@pytest.fixture(scope = 'module')
+def running():
+    ## socket paths are limited to about a hundred characters
+    tmp = tempfile.mkdtemp(prefix = "pynth")
+    sock = os.path.join(tmp, "pynth.sock")
+    srv, stop = server.start_in_thread(socket_path = sock, workers = 2, concurrency = 1)
+    yield srv, sock
+    stop()
+    shutil.rmtree(tmp, ignore_errors = True)
+
+@pytest.fixture(scope = 'module')
+def data(song):
+    with open(song, "rb") as f:
+        return f.read()
+
+def test_render_matches_a_local_render(running, data, song):
+    _, sock = running
+    flac, headers = server.render_remote(data, PARAMS, socket_path = sock)
+    remote, rate = sf.read(io.BytesIO(flac))
+    local, _ = midi_to_audio(song, **dict(PARAMS, region = tuple(PARAMS['region'])))
+    assert rate == defaults.SAMPLE_RATE
+    assert len(remote) == len(local)
+    ## FLAC stores 16-bit samples
+    assert np.max(np.abs(remote - local)) <= 2 / 32768
+    assert float(headers['X-Pynth-Audio-Seconds']) == pytest.approx(4.0, abs = 1e-3)
+
+def test_queued_jobs_run_by_priority(running, data):
+    srv, sock = running
+    order = []
+    def run(priority, params):
+        server.render_remote(data, params, priority, socket_path = sock)
+        order.append(priority)
+    ## a slow job keeps the only slot busy while the others are queued
+    blocker = threading.Thread(target = run, args = (0, dict(PARAMS, fx = defaults.DEFAULT_EFFECTS, region = None)))
+    blocker.start()
+    while srv.metrics['running'] == 0:
+        time.sleep(0.005)
+    queued = [threading.Thread(target = run, args = (p, PARAMS)) for p in (5, 1, 3)]
+    for t in queued:
+        t.start()
+    while srv.snapshot()['queue_depth'] < len(queued) and blocker.is_alive():
+        time.sleep(0.005)
+    for t in [blocker] + queued:
+        t.join()
+    assert order == [0, 1, 3, 5]
+
+DEFAULTS = {
+    'wf': 'sine',
+    'adsr': defaults.DEFAULT_ADSR,
+    'fx': defaults.DEFAULT_EFFECTS,
+    'osc': defaults.DEFAULT_OSCILLATORS,
+    'am_lfo': defaults.DEFAULT_AM_LFO,
+    'fm_lfo': defaults.DEFAULT_FM_LFO,
+    'filters': defaults.DEFAULT_FILTERS,
+    'automation': defaults.DEFAULT_AUTOMATION,
+    'voices': defaults.DEFAULT_VOICES,
+    'region': [1.0, 2.5],
+}
+
+## parameters changed from the defaults : (path, value)
+BAD_VALUES = [
+    (('voices', 'max_polyphony'), 10 ** 6),
+    (('voices', 'max_polyphony'), 8.5),
+    (('voices', 'max_polyphony'), True),
+    (('voices', 'steal'), 'newest'),
+    (('adsr', 'attack'), "0.1"),
+    (('adsr', 'release'), float('nan')),
+    (('adsr', 'sustain'), -0.5),
+    (('fx', 'delay', 'delay_time'), 1e9),
+    (('fx', 'reverb', 'size'), 0.5),
+    (('fx', 'flanger'), {}),
+    (('osc',), [DEFAULTS['osc'][0]] * 100),
+    (('osc', 0, 'waveform'), 'noise'),
+    (('filters', 'lowpass', 'order'), 40),
+    (('am_lfo', 'rate'), 0),
+    (('automation', 'smoothing'), None),
+    (('region',), [3.0, 1.0]),
+    (('region',), [-1.0, 1.0]),
+]
+
+def with_value(path, value):
+    params = copy.deepcopy(DEFAULTS)
+    target = params
+    for key in path[:-1]:
+        target = target[key]
+    target[path[-1]] = value
+    return params
+
+def test_default_parameters_are_accepted():
+    params = server.check_params(copy.deepcopy(DEFAULTS))
+    assert params['region'] == (1.0, 2.5)
+    assert params['voices'] == defaults.DEFAULT_VOICES
+
+@pytest.mark.parametrize('path, value', BAD_VALUES, ids = lambda v: str(v)[:20])
+def test_bad_values_are_refused(path, value):
+    with pytest.raises(ValueError):
+        server.check_params(with_value(path, value))
+
+def test_missing_values_are_refused():
+    adsr = dict(defaults.DEFAULT_ADSR)
+    del adsr['decay']
+    with pytest.raises(ValueError, match = "decay"):
+        server.check_params({'adsr': adsr})
+
+@pytest.mark.parametrize('params', [{'unknown': 1}, {'region': [1.0]}, "not an object", with_value(('voices', 'max_polyphony'), 10 ** 6)])
+def test_bad_parameters_are_refused(running, data, params):
+    _, sock = running
+    with pytest.raises(RuntimeError, match = "400"):
+        server.render_remote(data, params, socket_path = sock)
+
+def test_region_after_the_end_is_refused(running, data):
+    _, sock = running
+    with pytest.raises(RuntimeError, match = "422.*Empty region"):
+        server.render_remote(data, dict(PARAMS, region = [3600.0, 3610.0]), socket_path = sock)
+
+def test_unknown_path(running):
+    _, sock = running
+    conn = server.connect(socket_path = sock)
+    try:
+        conn.request("GET", "/nothing")
+        assert conn.getresponse().status == 404
+    finally:
+        conn.close()
+
+def test_metrics(running, data):
+    _, sock = running
+    server.render_remote(data, PARAMS, socket_path = sock)
+    metrics = server.fetch_metrics(socket_path = sock)
+    assert metrics['completed'] >= 1
+    assert metrics['queue_depth'] == 0
+    assert metrics['realtime_factor'] > 0
+
+# a worker that dies breaks the process pool : the jobs it ran fail, and the pool is started again
+def test_dead_worker_restarts_the_pool(data):
+    tmp = tempfile.mkdtemp(prefix = "pynth")
+    sock = os.path.join(tmp, "pynth.sock")
+    srv, stop = server.start_in_thread(socket_path = sock, workers = 1)
+    try:
+        pid = srv.worker_pids[0]
+        os.kill(pid, signal.SIGKILL)
+        failures = 0
+        for _ in range(3):
+            try:
+                server.render_remote(data, PARAMS, socket_path = sock)
+                break
+            except RuntimeError as e:
+                assert "500" in str(e)
+                failures += 1
+        assert failures == 1
+        metrics = server.fetch_metrics(socket_path = sock)
+        assert metrics['pool_restarts'] == failures
+        assert metrics['completed'] == 1
+        assert srv.worker_pids[0] != pid
+    finally:
+        stop()
+        shutil.rmtree(tmp, ignore_errors = True)
@@ -0,0 +1,50 @@
+# libraries
+import os
+import numpy as np
+import pytest
+import soundfile as sf
+from pynth import defaults, sweep
+from pynth.midi import midi_to_audio
+
+BASE = {
+    'fx': {'chorus': defaults.DEFAULT_EFFECTS['chorus'], 'delay': defaults.DEFAULT_EFFECTS['delay']},
+    'voices': dict(defaults.DEFAULT_VOICES, max_polyphony = 4),
+    'region': (4.0, 8.0),
+}
+AXES = {
+    'wf': ['sine', 'saw'],
+    'fx': [BASE['fx'], {'delay': defaults.DEFAULT_EFFECTS['delay'], 'reverb': defaults.DEFAULT_EFFECTS['reverb']}],
+    'filters': [None, {'lowpass': dict(defaults.DEFAULT_FILTERS['lowpass'], enabled = True)}],
+}
+# FLAC stores 16-bit samples, clipped to [-1, 1]
+TOLERANCE = 2 / 32768
+
+def check_variants(song, out_dir, base, overrides, workers):
+    manifest = sweep.run_sweep(song, str(out_dir), base, overrides, workers = workers)
+    assert len(manifest['variants']) == len(overrides)
+    for entry, override in zip(manifest['variants'], overrides):
+        audio, _ = sf.read(os.path.join(str(out_dir), entry['file']))
+        expected, _ = midi_to_audio(song, **sweep.apply_overrides(sweep.make_patch(**base), override))
+        assert len(audio) == len(expected)
+        assert np.max(np.abs(audio - np.clip(expected, -1.0, 1.0))) <= TOLERANCE, override
+    return manifest
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_variants_match_direct_renders(song, tmp_path, workers):
+    manifest = check_variants(song, tmp_path, BASE, sweep.grid(AXES), workers)
+    ## one track per waveform, one effect chain per (waveform, effects, rendered window)
+    assert manifest['computed']['tracks'] == 2
+    assert manifest['computed']['effects'] == 8
+
+def test_full_song_variants(song, tmp_path):
+    base = dict(BASE, region = None, osc = [dict(o, enabled = True) for o in defaults.DEFAULT_OSCILLATORS])
+    check_variants(song, tmp_path, base, sweep.grid({'osc.1.volume': [0.2, 0.9], 'adsr.attack': [0.01, 0.2]}), 1)
+
+def test_oscillator_overrides_follow_the_variant_waveform():
+    patch = sweep.apply_overrides(sweep.make_patch(), {'osc.0.volume': 0.5, 'wf': 'square'})
+    assert patch['osc'] == [{'enabled': True, 'waveform': 'square', 'volume': 0.5, 'pitch': 0}]
+
+def test_parse_grid():
+    assert sweep.parse_grid("fx.reverb.mix=0.1,0.3; wf=saw") == {'fx.reverb.mix': [0.1, 0.3], 'wf': ['saw']}
+    with pytest.raises(ValueError):
+        sweep.parse_grid("fx.reverb.mix")
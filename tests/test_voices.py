@@ -0,0 +1,58 @@
+# libraries
+import numpy as np
+import pytest
+from pynth import defaults
+from pynth.cancellation import CancelToken, RenderCancelled
+from pynth.midi import render_notes
+from pynth.voices import limit_polyphony
+
+ADSR = {'attack': 0.05, 'decay': 0.1, 'sustain': 0.7, 'release': 0.3}
+## three overlapping notes : the third one steals the voice of the first one at 1.5 s
+NOTES = [(0.0, 2.0, 60, 100), (0.5, 2.5, 64, 100), (1.5, 3.0, 67, 100)]
+STEAL = int(1.5 * defaults.SAMPLE_RATE)
+
+def render(notes, max_polyphony):
+    voices = dict(defaults.DEFAULT_VOICES, max_polyphony = max_polyphony, steal = 'oldest')
+    return render_notes(notes, defaults.DEFAULT_TEMPO, adsr = ADSR, voices = voices)
+
+def test_limit_polyphony_keeps_note_ends():
+    notes, voices, cuts = limit_polyphony(NOTES, 2, 'oldest')
+    assert notes == NOTES
+    assert voices[2] == voices[0]
+    assert cuts == [1.5, None, None]
+
+def test_notes_stolen_at_their_start_are_dropped():
+    notes, voices, cuts = limit_polyphony([(0.0, 1.0, 60, 100), (0.0, 1.0, 64, 100)], 1, 'oldest')
+    assert notes == [(0.0, 1.0, 64, 100)]
+
+def test_stolen_note_is_unchanged_before_the_steal():
+    full = render(NOTES, 3)
+    limited = render(NOTES, 2)
+    assert len(full) == len(limited)
+    np.testing.assert_array_equal(limited[:STEAL], full[:STEAL])
+
+def test_stolen_note_fades_out():
+    limited = render(NOTES, 2)
+    alone = render(NOTES[1:], 3)
+    ## once the fade is over, only the two other notes are left
+    after = STEAL + int(defaults.STEAL_FADE * defaults.SAMPLE_RATE) + 1
+    np.testing.assert_allclose(limited[after:], alone[after:], atol = 1e-6)
+
+def test_progress_counts_samples():
+    seen = []
+    ## a short note, then a note nine times longer
+    render_notes([(0.0, 1.0, 60, 100), (1.0, 10.0, 64, 100)], defaults.DEFAULT_TEMPO, adsr = ADSR, progress = seen.append)
+    assert seen == sorted(seen)
+    assert seen[-1] == 1.0
+    assert max(f for f in seen if f <= 0.1 + 1e-9) == pytest.approx(0.1, abs = 1e-3)
+
+def test_long_note_can_be_cancelled():
+    token = CancelToken()
+    seen = []
+    def progress(fraction):
+        seen.append(fraction)
+        token.cancel()
+    ## a single note : the token is checked between its blocks
+    with pytest.raises(RenderCancelled):
+        render_notes([(0.0, 30.0, 60, 100)], defaults.DEFAULT_TEMPO, adsr = ADSR, cancel = token, progress = progress)
+    assert len(seen) == 1